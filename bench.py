@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+"""Micro benchmarks for py-gnhast
+
+Run all of them with ``python bench.py`` or pick some by name, for
+example ``python bench.py lookup``.
+"""
+import asyncio
+import copy
+import os
+import random
+import shlex
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+from gnhast.devices import Device, DeviceRegistry
+from gnhast.alarms import AlarmTable
+from gnhast import protocol
+from gnhast import gnhast
+from gnhast import units
+
+
+def _best(stmt, number, repeat=5):
+    return min(timeit.repeat(stmt, number=number, repeat=repeat)) / number
+
+
+def bench_lookup():
+    """find_dev_byuid: uid index vs the old linear scan"""
+    print('{0:>8} {1:>14} {2:>14}'.format('devices', 'index (ns)', 'scan (ns)'))
+    for count in [100, 1000, 10000, 100000]:
+        devs = [{'uid': 'dev{0:06d}'.format(i)} for i in range(count)]
+        reg = DeviceRegistry(devs)
+        uids = [random.choice(devs)['uid'] for i in range(1000)]
+
+        def index():
+            for uid in uids:
+                reg.find(uid)
+
+        def scan():
+            for uid in uids:
+                for dev in devs:
+                    if uid == dev['uid']:
+                        break
+
+        idx = _best(index, 10) / len(uids) * 1e9
+        if count <= 10000:
+            lin = '{0:14.1f}'.format(_best(scan, 1, 1) / len(uids) * 1e9)
+        else:
+            lin = '{0:>14}'.format('-')
+        print('{0:>8} {1:14.1f} {2}'.format(count, idx, lin))
+
+
+def bench_alarms():
+    """dumpalarms flood into the AlarmTable, then a channel/sev query"""
+    chans = [1, 2, 8, 16, 512, 8 | 512]
+    print('{0:>8} {1:>14} {2:>14}'.format('alarms', 'add (ns)', 'select (us)'))
+    for count in [100, 1000, 10000, 100000]:
+        alarms = [{'aluid': 'al{0:06d}'.format(i), 'altext': '',
+                   'alsev': random.randint(1, 10),
+                   'alchan': random.choice(chans)} for i in range(count)]
+
+        def flood():
+            table = AlarmTable()
+            for alarm in alarms:
+                table.add(alarm)
+            return table
+
+        add = _best(flood, 1, 3) / count * 1e9
+        table = flood()
+        sel = _best(lambda: table.select(8 | 512, 8), 10, 3) * 1e6
+        print('{0:>8} {1:14.1f} {2:14.1f}'.format(count, add, sel))
+
+
+def bench_device():
+    """Device() vs deepcopy of the old DEVICE template dict"""
+    template = {
+        'uid': '', 'loc': '', 'name': '', 'rrdname': '',
+        'proto': 0, 'type': 0, 'subtype': 0,
+        'scale': 0,
+        'data': 0, 'last': 0, 'min': 0, 'max': 0, 'avg': 0,
+        'lowat': 0, 'hiwat': 0, 'change': 0,
+        'handler': 0, 'hargs': dict(), 'tags': dict(),
+        'localdata': None,
+        'lastupd': 0,
+        'spamhandler': 0
+    }
+
+    def make_dict(i):
+        dev = copy.deepcopy(template)
+        dev['uid'] = 'dev{0:06d}'.format(i)
+        dev['name'] = 'Device'
+        dev['type'] = 3
+        dev['subtype'] = 3
+        return dev
+
+    def make_device(i):
+        return Device('dev{0:06d}'.format(i), 'Device', 3, 3)
+
+    count = 20000
+    print('{0:>8} {1:>14} {2:>14}'.format('', 'create (us)', 'bytes/dev'))
+    for name, make in [('dict', make_dict), ('Device', make_device)]:
+        per = _best(lambda: [make(i) for i in range(count)], 1, 3) / count
+        tracemalloc.start()
+        devs = [make(i) for i in range(count)]
+        size = tracemalloc.get_traced_memory()[0] / count
+        tracemalloc.stop()
+        del devs
+        print('{0:>8} {1:14.2f} {2:14.0f}'.format(name, per * 1e6, size))
+
+
+def bench_tokenize():
+    """protocol.tokenize vs shlex.split plus split(':') per word"""
+    lines = [
+        b'upd uid:28.0123456789AB temp:21.3750\n',
+        b'reg uid:28.0123456789AB name:"Outside Temp" rrdname:"outside" '
+        b'devt:3 subt:3 proto:4\n',
+        b'setalarm aluid:door1 altext:"Front door open" alsev:5 alchan:8\n',
+    ]
+    print('{0:>8} {1:>14} {2:>14}'.format('line', 'shlex (l/s)', 'tokenize (l/s)'))
+    for line in lines:
+        def old():
+            words = shlex.split(line.decode().rstrip())
+            return [words[0]] + [w.split(':') for w in words[1:]]
+
+        before = 1 / _best(old, 2000)
+        after = 1 / _best(lambda: protocol.tokenize(line), 2000)
+        print('{0:>8} {1:14.0f} {2:14.0f}'.format(line.split()[0].decode(),
+                                                  before, after))
+
+
+class _NullWriter:
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+
+def bench_update():
+    """10k updates: gn_update_device per call vs gn_update_devices, and
+    gn_update_devices with track_stats on"""
+    gn = gnhast.gnhast(None, '')
+    gn.writer = _NullWriter()
+    devs = [gn.new_device('dev{0:06d}'.format(i), 'Device', 3, 3)
+            for i in range(10000)]
+    for i, dev in enumerate(devs):
+        dev['data'] = 20 + i / 1000
+
+    async def per_call():
+        for dev in devs:
+            await gn.gn_update_device(dev)
+
+    async def bulk():
+        await gn.gn_update_devices(devs)
+
+    loop = asyncio.new_event_loop()
+    for name, func in [('per call', per_call), ('bulk', bulk)]:
+        per = _best(lambda: loop.run_until_complete(func()), 1, 5)
+        print('{0:>12} {1:10.2f} ms/10k'.format(name, per * 1e3))
+    gn.track_stats = True
+    per = _best(lambda: loop.run_until_complete(bulk()), 1, 5)
+    print('{0:>12} {1:10.2f} ms/10k'.format('bulk+stats', per * 1e3))
+    loop.close()
+
+
+def bench_temp():
+    """gn_scale_temp: pint per call vs cached pint vs affine vs batch"""
+    from pint import UnitRegistry
+    gn = gnhast.gnhast(None, '')
+    temps = [random.uniform(-40, 120) for i in range(10000)]
+
+    def fresh_pint():
+        ureg = UnitRegistry()
+        return ureg.Quantity(temps[0], ureg.degF).to('degC').magnitude
+
+    ureg = UnitRegistry()
+
+    def cached_pint():
+        for t in temps[:1000]:
+            ureg.Quantity(t, ureg.degF).to('degC').magnitude
+
+    def fast():
+        for t in temps:
+            gn.gn_scale_temp(t, 'f', 'c')
+
+    print('{0:>12} {1:14.3f} us/reading'.format(
+        'pint/call', _best(fresh_pint, 1, 3) * 1e6))
+    print('{0:>12} {1:14.3f} us/reading'.format(
+        'cached pint', _best(cached_pint, 1, 3) / 1000 * 1e6))
+    print('{0:>12} {1:14.3f} us/reading'.format(
+        'affine', _best(fast, 1) / len(temps) * 1e6))
+    print('{0:>12} {1:14.3f} us/reading'.format(
+        'batch', _best(lambda: gn.gn_scale_temps(temps, 'f', 'c'), 10)
+        / len(temps) * 1e6))
+
+
+def bench_confparse():
+    """confuseparse.parse on configs of growing size, should scale linearly"""
+    from gnhast import confuseparse
+    block = ('device "dev{0:06d}" {{\n'
+             '  name = "Device {0}"\n'
+             '  rrdname = "dev{0}"\n'
+             '  proto = "sensor"\n'
+             '  type = "sensor"\n'
+             '  subtype = "temp"\n'
+             '  tscale = "C"\n'
+             '}}\n')
+    print('{0:>8} {1:>14} {2:>14}'.format('devices', 'parse (ms)', 'us/device'))
+    for count in [100, 1000, 10000]:
+        text = ''.join(block.format(i) for i in range(count))
+        per = _best(lambda: confuseparse.parse(text), 1, 3)
+        print('{0:>8} {1:14.2f} {2:14.2f}'.format(count, per * 1e3,
+                                                  per / count * 1e6))
+
+
+def bench_log():
+    """LOG_DEBUG per line: eager format + print vs template + writer thread"""
+    from datetime import datetime
+    gn = gnhast.gnhast(None, '')
+    gn.log = open(os.devnull, 'w')
+    # measure queueing, not the full-queue drop path
+    gn._logwriter.maxsize = 1000000
+    dev = {'name': 'Outside Temp'}
+    count = 20000
+
+    def old():
+        for i in range(count):
+            msg = "Updated device: {0}".format(dev['name'])
+            if gn.debug:
+                print('{0} [DEBUG]:'.format(datetime.now().ctime()) + msg,
+                      file=gn.log)
+
+    def new():
+        for i in range(count):
+            gn.LOG_DEBUG("Updated device: {0}", dev['name'])
+
+    print('{0:>8} {1:>14} {2:>14}'.format('debug', 'old (ns)', 'new (ns)'))
+    for debug in [False, True]:
+        gn.debug = debug
+        before = _best(old, 1) / count * 1e9
+        after = _best(new, 1) / count * 1e9
+        gn.log_flush()
+        print('{0:>8} {1:14.1f} {2:14.1f}'.format(str(debug), before, after))
+    gn.log.close()
+
+
+def bench_subscribe():
+    """finding callbacks for an upd: subscription index vs a uid if-chain"""
+    from gnhast.subscriptions import SubscriptionRegistry
+    dev = Device('dev000500', 'Device', 3, 3)
+    print('{0:>8} {1:>14} {2:>14}'.format('subs', 'chain (ns)', 'index (ns)'))
+    for count in [10, 100, 1000, 10000]:
+        reg = SubscriptionRegistry()
+        uids = ['dev{0:06d}'.format(i) for i in range(count)]
+        for uid in uids:
+            reg.add('upd', print, uid=uid)
+
+        def chain():
+            for uid in uids:
+                if dev['uid'] == uid:
+                    pass
+
+        before = _best(chain, 1000) * 1e9
+        after = _best(lambda: reg.match('upd', dev), 1000) * 1e9
+        print('{0:>8} {1:14.1f} {2:14.1f}'.format(count, before, after))
+
+
+def bench_history():
+    """1000 devices x 1440 readings: lists of floats vs HistoryStore"""
+    from gnhast.history import HistoryStore
+    devices = 1000
+    samples = 1440
+    values = [random.uniform(0, 100) for i in range(samples)]
+
+    tracemalloc.start()
+    lists = dict()
+    for d in range(devices):
+        lists[d] = ([float(1000 + i * 60) for i in range(samples)],
+                    [v + d for v in values])
+    list_mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    store = HistoryStore(samples)
+    for d in range(devices):
+        for i, v in enumerate(values):
+            store.record(d, v + d, 1000.0 + i * 60)
+    hist_mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    since = 1000.0 + (samples - 60) * 60
+    times, vals = lists[0]
+
+    def list_mean():
+        sel = [v for t, v in zip(times, vals) if t >= since]
+        return sum(sel) / len(sel)
+
+    hist = store.get(0)
+    print('{0:>8} {1:>14} {2:>14}'.format('', 'MB', 'mean 1h (us)'))
+    print('{0:>8} {1:14.1f} {2:14.1f}'.format(
+        'lists', list_mem / 1e6, _best(list_mean, 100) * 1e6))
+    print('{0:>8} {1:14.1f} {2:14.1f}'.format(
+        'history', hist_mem / 1e6, _best(lambda: hist.mean(since), 100) * 1e6))
+    print('{0:>8} {1:>14} {2:14.1f}'.format(
+        'slope', '', _best(lambda: hist.slope(since), 100) * 1e6))
+    print('{0:>8} {1:>14} {2:14.1f}'.format(
+        'p90', '', _best(lambda: hist.percentile(90, since), 100) * 1e6))
+
+
+def bench_columnar():
+    """100k devices: DeviceRegistry of Device vs ColumnarRegistry"""
+    from gnhast.columnar import ColumnarRegistry
+    count = 100000
+    now = 1000000.0
+    units.get_numpy()
+
+    # every device gets its own strings and numbers, as parsed off the wire
+    def make(i):
+        dev = Device('dev{0:06d}'.format(i), 'Device {0}'.format(i % 500),
+                     3, random.choice([3, 4, 5, 12]))
+        dev.proto = 4
+        dev.data = random.uniform(-10, 40)
+        dev.lastupd = int(now - random.uniform(0, 330))
+        return dev
+
+    random.seed(1)
+    tracemalloc.start()
+    reg = DeviceRegistry(make(i) for i in range(count))
+    reg_mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    random.seed(1)
+    tracemalloc.start()
+    table = ColumnarRegistry((make(i) for i in range(count)), capacity=count)
+    col_mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    def reg_hot():
+        return [d for d in reg if d['subtype'] == 3 and d['data'] > 30]
+
+    def reg_stale():
+        return [d for d in reg if d['lastupd'] < now - 300]
+
+    print('{0:>10} {1:>10} {2:>14} {3:>14}'.format(
+        '', 'bytes/dev', 'temp>30 (ms)', 'stale (ms)'))
+    print('{0:>10} {1:10.0f} {2:14.2f} {3:14.2f}'.format(
+        'registry', reg_mem / count, _best(reg_hot, 1, 3) * 1e3,
+        _best(reg_stale, 1, 3) * 1e3))
+    print('{0:>10} {1:10.0f} {2:14.2f} {3:14.2f}'.format(
+        'columnar', col_mem / count,
+        _best(lambda: table.select(subtype=3, above=30), 1, 3) * 1e3,
+        _best(lambda: table.stale(300, now), 1, 3) * 1e3))
+    print('{0:>10} {1:>14} {2:>14}'.format('', 'registry (us)',
+                                            'columnar (us)'))
+    print('{0:>10} {1:14.2f} {2:14.2f}'.format(
+        'find+get', _best(lambda: reg.find('dev050000')['data'], 10000) * 1e6,
+        _best(lambda: table.find('dev050000')['data'], 10000) * 1e6))
+
+
+def bench_import():
+    """import gnhast.gnhast, as python -X importtime sees it
+
+    tests/test_import.py fails if a heavy module is imported eagerly.
+    """
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                          'import gnhast.gnhast'],
+                         stderr=subprocess.PIPE, universal_newlines=True)
+    total = 0
+    for line in out.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        if parts[2].strip() == 'gnhast.gnhast':
+            total = max(total, int(parts[1]))
+    print('{0:>12} {1:10.1f} ms'.format('cumulative', total / 1000))
+
+
+BENCHES = {
+    'lookup': bench_lookup,
+    'alarms': bench_alarms,
+    'device': bench_device,
+    'tokenize': bench_tokenize,
+    'update': bench_update,
+    'temp': bench_temp,
+    'confparse': bench_confparse,
+    'log': bench_log,
+    'subscribe': bench_subscribe,
+    'history': bench_history,
+    'columnar': bench_columnar,
+    'import': bench_import,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHES:
+        print('== ' + name)
+        BENCHES[name]()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+.. module:: alarms
+Alarm storage for gnhast
+"""
+
+
+def chan_bits(alchan):
+    """Split an alarm channel mask into its single bit values
+
+    :param alchan: AlarmChan or int channel mask
+    :returns: list of the bits set in the mask
+    :rtype: list
+    """
+    mask = int(alchan) & 0xFFFFFFFF
+    bits = []
+    while mask:
+        bit = mask & -mask
+        bits.append(bit)
+        mask ^= bit
+    return bits
+
+
+class AlarmTable:
+    """Table of active alarms, indexed by aluid, channel bit and severity.
+
+    Alarms are plain dicts shaped like ``gnhast.ALARM``.  Besides the aluid
+    index, every alarm is filed under each AlarmChan bit it carries and
+    under its severity, so a query such as "all Security or Emergency
+    alarms at severity 3 or more" only touches the matching buckets.
+    """
+
+    def __init__(self):
+        self._byuid = dict()
+        self._bychan = dict()
+        self._bysev = dict()
+        # the (sev, chan) each aluid is currently filed under
+        self._keys = dict()
+
+    def _unindex(self, aluid):
+        sev, chan = self._keys.pop(aluid)
+        bucket = self._bysev[sev]
+        del bucket[aluid]
+        if not bucket:
+            del self._bysev[sev]
+        for bit in chan_bits(chan):
+            bucket = self._bychan[bit]
+            del bucket[aluid]
+            if not bucket:
+                del self._bychan[bit]
+
+    def add(self, alarm):
+        """Add or refresh an alarm, re-indexing it if sev or chan changed
+
+        :param alarm: alarm dict
+        :returns: the alarm
+        :rtype: dict
+        """
+        aluid = alarm['aluid']
+        sev = int(alarm['alsev'])
+        chan = int(alarm['alchan'])
+        if aluid in self._keys:
+            if self._keys[aluid] == (sev, chan) and \
+               self._byuid[aluid] is alarm:
+                return alarm
+            self._unindex(aluid)
+        self._byuid[aluid] = alarm
+        self._keys[aluid] = (sev, chan)
+        self._bysev.setdefault(sev, dict())[aluid] = alarm
+        for bit in chan_bits(chan):
+            self._bychan.setdefault(bit, dict())[aluid] = alarm
+        return alarm
+
+    def find(self, aluid):
+        """Look up an alarm by aluid
+
+        :param aluid: aluid to search for
+        :returns: alarm dict or None
+        :rtype: dict
+        """
+        return self._byuid.get(aluid)
+
+    def remove(self, alarm):
+        """Remove an alarm from the table
+
+        :param alarm: alarm, or aluid of the alarm, to remove
+        :returns: the removed alarm or None if it was not present
+        :rtype: dict
+        """
+        aluid = alarm if isinstance(alarm, str) else alarm['aluid']
+        if aluid not in self._byuid:
+            return None
+        self._unindex(aluid)
+        return self._byuid.pop(aluid)
+
+    def select(self, alchan=-1, minsev=1):
+        """Find all alarms on any of the given channels at or above a severity
+
+        :param alchan: AlarmChan mask to match (default all channels)
+        :param minsev: minimum severity (default 1)
+        :returns: matching alarms, highest severity first
+        :rtype: list
+        """
+        sevs = sorted((s for s in self._bysev if s >= minsev), reverse=True)
+        if int(alchan) == -1:
+            return [al for s in sevs for al in self._bysev[s].values()]
+
+        matched = dict()
+        for bit in chan_bits(alchan):
+            if bit in self._bychan:
+                matched.update(self._bychan[bit])
+        result = []
+        for s in sevs:
+            bucket = self._bysev[s]
+            if len(bucket) < len(matched):
+                result.extend(al for uid, al in bucket.items()
+                              if uid in matched)
+            else:
+                result.extend(al for uid, al in matched.items()
+                              if uid in bucket)
+        return result
+
+    def by_severity(self):
+        """All alarms, highest severity first"""
+        return self.select(-1, minsev=float('-inf'))
+
+    def clear(self):
+        self._byuid.clear()
+        self._bychan.clear()
+        self._bysev.clear()
+        self._keys.clear()
+
+    def __contains__(self, aluid):
+        return aluid in self._byuid
+
+    def __iter__(self):
+        return iter(list(self._byuid.values()))
+
+    def __len__(self):
+        return len(self._byuid)
+
+    def __repr__(self):
+        return 'AlarmTable({0!r})'.format(list(self._byuid.values()))
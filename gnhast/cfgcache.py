@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+.. module:: cfgcache
+Cache of parsed config files
+
+Parsing a config file and translating every device entry is the bulk of
+collector start up, and the config file rarely changes between runs.  The
+final parsed config is written to a cache file with marshal, together with
+a fingerprint of the config file (absolute path, mtime, size and a hash of
+the content).  It is only used again while the fingerprint still matches.
+
+marshal only stores plain data (dicts, lists, strings, numbers), so
+loading a cache cannot run code the way unpickling can.  The cache is
+also only read if it is owned by us (or root) and nobody else can write
+to it.
+"""
+
+import hashlib
+import marshal
+import os
+import stat
+
+# Bump when the layout of the parsed config changes
+CACHE_VERSION = 2
+
+
+def cache_path(cfgfile, cachedir=None):
+    """Where the cache for a config file lives
+
+    :param cfgfile: path of the config file
+    :param cachedir: directory to keep caches in, or None to put the cache
+        next to the config file
+    :returns: path of the cache file
+    :rtype: str
+    """
+    cfgfile = os.path.abspath(cfgfile)
+    if cachedir is None:
+        return cfgfile + '.cache'
+    name = hashlib.sha1(cfgfile.encode()).hexdigest()
+    return os.path.join(cachedir, os.path.basename(cfgfile) + '-' + name
+                        + '.cache')
+
+
+def fingerprint(cfgfile, extra=None):
+    """Fingerprint a config file
+
+    :param cfgfile: path of the config file
+    :param extra: anything else the parse result depends on, such as the
+        conversion tables, plain data that marshal can store
+    :returns: fingerprint, compare with ==
+    :rtype: tuple
+    :raises OSError: if the file cannot be read
+    """
+    cfgfile = os.path.abspath(cfgfile)
+    with open(cfgfile, 'rb') as f:
+        st = os.fstat(f.fileno())
+        digest = hashlib.sha1(f.read()).hexdigest()
+    if extra is not None:
+        extra = hashlib.sha1(marshal.dumps(extra)).hexdigest()
+    return (CACHE_VERSION, cfgfile, st.st_mtime_ns, st.st_size, digest,
+            extra)
+
+
+def _trusted(f):
+    # only trust a cache that we (or root) own and only the owner can write
+    st = os.fstat(f.fileno())
+    if not stat.S_ISREG(st.st_mode):
+        return False
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        return False
+    if hasattr(os, 'getuid') and st.st_uid not in (0, os.getuid()):
+        return False
+    return True
+
+
+def load(path, key):
+    """Load a cached config
+
+    :param path: cache file
+    :param key: fingerprint the cache must have been stored with
+    :returns: the cached config, or None if there is no cache, it is
+        stale, it cannot be read, or it is owned or writable by someone
+        else
+    :rtype: dict
+    """
+    try:
+        with open(path, 'rb') as f:
+            if not _trusted(f):
+                return None
+            cached_key, config = marshal.load(f)
+    except Exception:
+        return None
+    if cached_key != key or not isinstance(config, dict):
+        return None
+    return config
+
+
+def store(path, key, config):
+    """Store a parsed config
+
+    The cache is written to a temporary file and renamed into place, so a
+    reader never sees a half written cache.
+
+    :param path: cache file
+    :param key: fingerprint of the config file
+    :param config: parsed config
+    :raises OSError: if the cache cannot be written
+    :raises ValueError: if the config holds something marshal cannot store
+    """
+    data = marshal.dumps((key, config))
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,540 @@
+#!/usr/bin/env python
+"""
+.. module:: columnar
+Columnar device table for very large device counts
+
+A drop in replacement for devices.DeviceRegistry that keeps one typed
+array per numeric field instead of one Python object per device.  Strings
+(name, loc, rrdname) are interned in a side table and stored as ids, uids
+are kept in a plain list shared with the uid index.
+Devices are handed out as DeviceRow proxies that behave like the dicts
+and Device objects the rest of gnhast uses, and bulk queries run as array
+expressions over whole columns.  The arrays are numpy arrays if numpy is
+installed, array.array otherwise (queries then fall back to loops).
+"""
+
+from array import array
+from collections.abc import MutableMapping
+
+from gnhast import units
+from gnhast.devices import DEVICE_FIELDS, Device
+
+STRING_FIELDS = ('loc', 'name', 'rrdname')
+INT_FIELDS = ('proto', 'type', 'subtype', 'scale', 'handler', 'spamhandler')
+FLOAT_FIELDS = ('data', 'last', 'min', 'max', 'avg', 'lowat', 'hiwat',
+                'change', 'lastupd')
+OBJECT_FIELDS = ('hargs', 'tags', 'localdata')
+# where a Device keeps them, without creating empty hargs and tags
+_DEVICE_OBJECTS = {'hargs': '_hargs', 'tags': '_tags',
+                   'localdata': 'localdata'}
+
+_NUMPY_TYPES = {'d': 'float64', 'i': 'int32', 'I': 'uint32', 'B': 'uint8'}
+_INT_MIN = -2 ** 31
+_INT_MAX = 2 ** 31 - 1
+_FLOAT_EXACT = 2 ** 53
+
+# field -> (kind, int bit, boxed bit).  The per row mask column has an
+# "int" bit for every float field, set when the value stored was an int
+# so it reads back as one, and a "boxed" bit for every string and numeric
+# field, set when the value does not fit the column and lives in the
+# row's side dict instead.
+_LAYOUT = dict()
+for _n, _f in enumerate(FLOAT_FIELDS):
+    _LAYOUT[_f] = ('f', 1 << _n, 1 << (len(FLOAT_FIELDS) + _n))
+for _n, _f in enumerate(INT_FIELDS):
+    _LAYOUT[_f] = ('i', 0, 1 << (2 * len(FLOAT_FIELDS) + _n))
+for _n, _f in enumerate(STRING_FIELDS):
+    _LAYOUT[_f] = ('s', 0, 1 << (2 * len(FLOAT_FIELDS) + len(INT_FIELDS)
+                                 + _n))
+del _n, _f
+
+
+class DeviceRow(MutableMapping):
+    """One device of a ColumnarRegistry.
+
+    A view on a row of the table: reads and writes go straight to the
+    columns, so every proxy for a device sees the same data.  Proxies are
+    cheap and made on demand; compare them with ==, not ``is``.  A proxy
+    must not be used after its device is removed from the table.
+    """
+
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    def __getitem__(self, key):
+        return self._table._get(self._row, key)
+
+    def __setitem__(self, key, value):
+        self._table._set(self._row, key, value)
+
+    def __delitem__(self, key):
+        extra = self._table._extra.get(self._row)
+        if key in _LAYOUT or key in OBJECT_FIELDS or key == 'uid':
+            raise KeyError('cannot delete device field {0}'.format(key))
+        if extra is None or key not in extra:
+            raise KeyError(key)
+        del extra[key]
+
+    def __contains__(self, key):
+        if key in _LAYOUT or key in OBJECT_FIELDS or key == 'uid':
+            return True
+        extra = self._table._extra.get(self._row)
+        return extra is not None and key in extra
+
+    def __iter__(self):
+        yield from DEVICE_FIELDS
+        extra = self._table._extra.get(self._row)
+        if extra is not None:
+            yield from list(extra)
+
+    def __len__(self):
+        extra = self._table._extra.get(self._row)
+        return len(DEVICE_FIELDS) + (len(extra) if extra else 0)
+
+    def __eq__(self, other):
+        if isinstance(other, DeviceRow) and other._table is self._table:
+            return other._row == self._row
+        return MutableMapping.__eq__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'DeviceRow({0!r})'.format(dict(self.items()))
+
+
+class ColumnarRegistry:
+    """Device table stored as typed columns, indexed by uid.
+
+    Offers the same interface as devices.DeviceRegistry, so it can be
+    used as ``gnhast.devices``, see gnhast.gn_columnar_devices().  add()
+    copies the device into a row and returns its DeviceRow; keep using
+    the returned row, later changes to the object passed in are not seen.
+
+    :param capacity: rows to allocate up front, the table doubles when
+        it runs out
+    """
+
+    def __init__(self, devices=(), capacity=1024):
+        self.history = None
+        self._numpy = units.get_numpy()
+        self._capacity = 0
+        self._nrows = 0
+        self._free = []
+        self._byuid = dict()
+        self._uids = []
+        self._strings = ['']
+        self._strid = {'': 0}
+        self._cols = dict()
+        for field in FLOAT_FIELDS:
+            self._cols[field] = self._new_column('d', 0)
+        for field in INT_FIELDS + STRING_FIELDS:
+            self._cols[field] = self._new_column('i', 0)
+        self._mask = self._cols['_mask'] = self._new_column('I', 0)
+        self._alive = self._cols['_alive'] = self._new_column('B', 0)
+        # sparse side tables, row -> dict
+        self._objs = dict()
+        self._extra = dict()
+        self._boxed = dict()
+        self._grow(max(capacity, 16))
+        for dev in devices:
+            self.add(dev)
+
+    # storage
+
+    def _new_column(self, code, size):
+        if self._numpy is not None:
+            return self._numpy.zeros(size, dtype=_NUMPY_TYPES[code])
+        return array(code, bytes(array(code).itemsize * size))
+
+    def _grow(self, capacity):
+        # always copy into new columns: views handed out by column() keep
+        # the old ones alive, and an array exporting a buffer cannot be
+        # resized in place
+        for name, col in self._cols.items():
+            if self._numpy is not None:
+                new = self._numpy.zeros(capacity, dtype=col.dtype)
+            else:
+                new = array(col.typecode, bytes(col.itemsize * capacity))
+            new[:self._capacity] = col
+            self._cols[name] = new
+        self._mask = self._cols['_mask']
+        self._alive = self._cols['_alive']
+        self._capacity = capacity
+
+    def _intern(self, text):
+        sid = self._strid.get(text)
+        if sid is None:
+            sid = len(self._strings)
+            self._strings.append(text)
+            self._strid[text] = sid
+        return sid
+
+    def _new_row(self):
+        if self._free:
+            row = self._free.pop()
+        else:
+            if self._nrows == self._capacity:
+                self._grow(self._capacity * 2)
+            row = self._nrows
+            self._nrows += 1
+            self._uids.append('')
+        self._reset_row(row)
+        return row
+
+    def _reset_row(self, row):
+        self._uids[row] = ''
+        for col in self._cols.values():
+            col[row] = 0
+        self._alive[row] = 1
+        self._objs.pop(row, None)
+        self._extra.pop(row, None)
+        self._boxed.pop(row, None)
+
+    def _drop_row(self, row):
+        self._uids[row] = ''
+        self._alive[row] = 0
+        self._objs.pop(row, None)
+        self._extra.pop(row, None)
+        self._boxed.pop(row, None)
+        self._free.append(row)
+
+    def _get(self, row, key):
+        layout = _LAYOUT.get(key)
+        if layout is None:
+            if key == 'uid':
+                return self._uids[row]
+            if key in OBJECT_FIELDS:
+                objs = self._objs.get(row)
+                if objs is not None and key in objs:
+                    return objs[key]
+                if key == 'localdata':
+                    return None
+                # hargs and tags start as empty dicts, made on first use
+                if objs is None:
+                    objs = self._objs[row] = dict()
+                value = objs[key] = dict()
+                return value
+            extra = self._extra.get(row)
+            if extra is None or key not in extra:
+                raise KeyError(key)
+            return extra[key]
+
+        kind, intbit, boxbit = layout
+        mask = self._mask[row]
+        if mask & boxbit:
+            return self._boxed[row][key]
+        value = self._cols[key][row]
+        if kind == 'f':
+            if mask & intbit:
+                return int(value)
+            return float(value)
+        if kind == 'i':
+            return int(value)
+        return self._strings[value]
+
+    def _set(self, row, key, value):
+        layout = _LAYOUT.get(key)
+        if layout is None:
+            if key == 'uid':
+                self._set_uid(row, value)
+                return
+            side = self._objs if key in OBJECT_FIELDS else self._extra
+            entry = side.get(row)
+            if entry is None:
+                entry = side[row] = dict()
+            entry[key] = value
+            return
+
+        kind, intbit, boxbit = layout
+        mask = int(self._mask[row]) & ~(intbit | boxbit)
+        col = self._cols[key]
+        stored = True
+        if isinstance(value, bool):
+            # would read back as an int
+            stored = False
+        elif kind == 'f':
+            if isinstance(value, float):
+                col[row] = value
+            elif isinstance(value, int) and \
+                    -_FLOAT_EXACT < value < _FLOAT_EXACT:
+                col[row] = value
+                mask |= intbit
+            else:
+                stored = False
+                col[row] = float('nan')
+        elif kind == 'i':
+            if isinstance(value, int) and _INT_MIN <= value <= _INT_MAX:
+                col[row] = value
+            else:
+                stored = False
+                col[row] = 0
+        elif isinstance(value, str):
+            col[row] = self._intern(value)
+        else:
+            stored = False
+            col[row] = 0
+
+        boxed = self._boxed.get(row)
+        if stored:
+            if boxed is not None:
+                boxed.pop(key, None)
+        else:
+            if boxed is None:
+                boxed = self._boxed[row] = dict()
+            boxed[key] = value
+            mask |= boxbit
+        self._mask[row] = mask
+
+    def _set_uid(self, row, uid):
+        old = self._uids[row]
+        if old == uid:
+            self._byuid[uid] = row
+            return
+        if self._byuid.get(old) == row:
+            del self._byuid[old]
+            if self.history is not None:
+                self.history.rename(old, uid)
+        other = self._byuid.get(uid)
+        if other is not None and other != row:
+            # a device with that uid is replaced, as add() would
+            self._drop_row(other)
+        self._uids[row] = uid
+        self._byuid[uid] = row
+
+    # DeviceRegistry interface
+
+    def add(self, dev):
+        """Add a device, replacing any existing device with the same uid
+
+        :param dev: device to add, any mapping with a uid
+        :returns: the row now holding the device
+        :rtype: DeviceRow
+        """
+        if isinstance(dev, DeviceRow) and dev._table is self:
+            return dev
+        uid = dev['uid']
+        row = self._byuid.get(uid)
+        if row is None:
+            row = self._new_row()
+        else:
+            self._reset_row(row)
+        isdev = isinstance(dev, Device)
+        for key in dev:
+            if key == 'uid':
+                continue
+            if key in OBJECT_FIELDS:
+                if isdev:
+                    value = getattr(dev, _DEVICE_OBJECTS[key])
+                else:
+                    value = dev[key]
+                # empty is the default, keep the side table sparse
+                if value:
+                    self._set(row, key, value)
+                continue
+            self._set(row, key, dev[key])
+        self._set_uid(row, uid)
+        return DeviceRow(self, row)
+
+    # list compatibility, collectors call gn.devices.append(dev)
+    append = add
+
+    def find(self, uid):
+        """Look up a device by uid
+
+        :param uid: uid to search for
+        :returns: the device or None
+        :rtype: DeviceRow
+        """
+        row = self._byuid.get(uid)
+        if row is None:
+            return None
+        return DeviceRow(self, row)
+
+    def remove(self, dev):
+        """Remove a device from the table
+
+        :param dev: device, or uid of the device, to remove
+        :returns: a plain dict copy of the removed device, or None if it
+            was not present
+        :rtype: dict
+        """
+        uid = dev if isinstance(dev, str) else dev['uid']
+        row = self._byuid.pop(uid, None)
+        if row is None:
+            return None
+        if self.history is not None:
+            self.history.remove(uid)
+        removed = dict(DeviceRow(self, row).items())
+        self._drop_row(row)
+        return removed
+
+    def reindex(self, dev, olduid):
+        """Move a device to a new uid after its uid was changed in place
+
+        Rows of this table are reindexed as soon as their uid is set, so
+        this only matters for devices that are not rows yet.
+
+        :param dev: the device, already carrying its new uid
+        :param olduid: the uid the device was registered under
+        :returns: the device's row
+        :rtype: DeviceRow
+        """
+        if isinstance(dev, DeviceRow) and dev._table is self:
+            return dev
+        row = self._byuid.get(olduid)
+        if row is not None:
+            self._set_uid(row, dev['uid'])
+            for key in dev:
+                self._set(row, key, dev[key])
+            return DeviceRow(self, row)
+        return self.add(dev)
+
+    def uids(self):
+        """All registered uids, in insertion order"""
+        return self._byuid.keys()
+
+    def clear(self):
+        for row in list(self._byuid.values()):
+            self._drop_row(row)
+        self._byuid.clear()
+        if self.history is not None:
+            self.history.clear()
+
+    def __contains__(self, item):
+        if isinstance(item, str):
+            return item in self._byuid
+        if isinstance(item, DeviceRow):
+            return item._table is self and \
+                self._byuid.get(item['uid']) == item._row
+        return False
+
+    def __iter__(self):
+        return iter([DeviceRow(self, row) for row in self._byuid.values()])
+
+    def __len__(self):
+        return len(self._byuid)
+
+    def __getitem__(self, index):
+        rows = list(self._byuid.values())[index]
+        if isinstance(index, slice):
+            return [DeviceRow(self, row) for row in rows]
+        return DeviceRow(self, rows)
+
+    def __repr__(self):
+        return 'ColumnarRegistry({0} devices)'.format(len(self))
+
+    # bulk queries
+
+    def column(self, field):
+        """The live column of a numeric field, one entry per row
+
+        Rows are not in insertion order, and rows of removed devices are
+        still there; combine with column('_alive') or use rows().  Values
+        that did not fit the column (boxed) read as NaN or 0.
+
+        :param field: a float or int field, or '_alive'
+        :returns: numpy array view, or memoryview without numpy.  A view
+            does not follow the table once it grows, take a new one after
+            adding devices.
+        """
+        col = self._cols[field]
+        if self._numpy is not None:
+            return col[:self._nrows]
+        return memoryview(col)[:self._nrows]
+
+    def rows(self, mask):
+        """The devices of the rows selected by a mask
+
+        :param mask: boolean numpy array over column() rows, or an
+            iterable of row numbers
+        :returns: the matching live devices
+        :rtype: list
+        """
+        if self._numpy is not None and hasattr(mask, 'dtype'):
+            mask = mask & (self.column('_alive') != 0)
+            rows = self._numpy.flatnonzero(mask).tolist()
+            return [DeviceRow(self, row) for row in rows]
+        alive = self._alive
+        return [DeviceRow(self, row) for row in mask if alive[row]]
+
+    def select(self, type=None, subtype=None, proto=None, above=None,
+               below=None):
+        """Find devices by type, subtype, proto and data range
+
+        ``select(subtype=3, above=30)`` finds every temperature sensor
+        reading more than 30.
+
+        :param type: device type (int)
+        :param subtype: device subtype (int)
+        :param proto: device protocol (int)
+        :param above: data strictly greater than this
+        :param below: data strictly less than this
+        :returns: matching devices
+        :rtype: list
+        """
+        tests = []
+        for field, value in (('type', type), ('subtype', subtype),
+                             ('proto', proto)):
+            if value is not None:
+                tests.append((field, '==', value))
+        if above is not None:
+            tests.append(('data', '>', above))
+        if below is not None:
+            tests.append(('data', '<', below))
+        return self._query(tests)
+
+    def stale(self, age, now=None):
+        """Find devices that have not been updated for a while
+
+        :param age: seconds since the last update
+        :param now: current time, default time.time()
+        :returns: devices with a lastupd older than now - age
+        :rtype: list
+        """
+        if now is None:
+            import time
+            now = time.time()
+        return self._query([('lastupd', '<', now - age)])
+
+    def _query(self, tests):
+        if self._numpy is not None:
+            mask = self.column('_alive') != 0
+            for field, op, value in tests:
+                col = self.column(field)
+                if op == '==':
+                    mask &= col == value
+                elif op == '>':
+                    mask &= col > value
+                else:
+                    mask &= col < value
+            return self.rows(mask)
+
+        cols = [(self._cols[field], op, value) for field, op, value in tests]
+        alive = self._alive
+        found = []
+        for row in range(self._nrows):
+            if not alive[row]:
+                continue
+            for col, op, value in cols:
+                cell = col[row]
+                if op == '==':
+                    ok = cell == value
+                elif op == '>':
+                    ok = cell > value
+                else:
+                    ok = cell < value
+                if not ok:
+                    break
+            else:
+                found.append(DeviceRow(self, row))
+        return found
+
+    @property
+    def nbytes(self):
+        """Memory used by the columns"""
+        if self._numpy is not None:
+            return sum(col.nbytes for col in self._cols.values())
+        return sum(col.itemsize * len(col) for col in self._cols.values())
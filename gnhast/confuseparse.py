@@ -1,30 +1,23 @@
 #!/usr/bin/env python
+"""
+.. module:: confuseparse
+Parser for libconfuse style gnhast config files
 
-import ply.lex
-import ply.yacc
+A single pass, hand written recursive descent parser.  It reads the file
+a line at a time and accepts what the old ply grammar accepted once
+parse_cfg had added its semicolons:
 
-# Viciously stolen and hacked up from:
-# https://bitbucket.org/thesheep/iscconf/src
-# Added the ignore of the = sign.
+* ``key = value`` or ``key value``, ended by a newline or ``;``
+  (``=`` is optional and ignored)
+* ``key = value, value, ...`` lists
+* ``key { ... }`` blocks, optionally followed by ``;``
+* ``device "uid" { ... }``, which becomes the key ``device-uid``
+* ``#`` comments
 
-tokens = (
-    'NAME', 'IPADDR', 'DOMAIN', 'MACADDR',
-    'BRACE_OPEN', 'BRACE_CLOSE', 'SEMICOLON', 'COMMA',
-    'STRING', 'INTEGER', 'FLOAT', 'CIDR4'
-)
+Values are ints, floats or strings.  Bare MAC addresses are lowercased.
+"""
 
-
-t_ignore = ' \t='
-# Added ! for support of allow-query { !key external; };
-t_NAME = r'[a-zA-Z!][a-zA-Z0-9-_]*[a-zA-Z0-9]*'
-t_IPADDR = r'([0-2]?[0-9]?[0-9][.]){3}[0-2]?[0-9]?[0-9]'
-t_DOMAIN = r'([a-z][a-z0-9-]*[.])+[a-z][a-z0-9-]*[.]?'
-t_BRACE_OPEN = r'{'
-t_BRACE_CLOSE = r'}'
-t_SEMICOLON = ';'
-t_COMMA = ','
-t_CIDR4 = r'([0-2]?[0-9]?[0-9][.]){3}[0-2]?[0-9]?[0-9]/[0-3]?[0-9]'
-t_ignore_COMMENT = r'[#][^\n]*'
+import re
 
 
 class Error(Exception):
@@ -39,133 +32,173 @@ class LexicalError(Error):
     pass
 
 
-def t_MACADDR(t):
-    r'([0-9a-fA-F][0-9a-fA-F]:){5}[0-9a-fA-F][0-9a-fA-F]'
-    t.value = t.value.lower()
-    return t
-
-
-def t_INTEGER(t):
-    r'-?[0-9]+(?![a-fA-F0-9:.])'  # Avoid conflicts with MAC and IP addresses
-    t.value = int(t.value)
-    return t
-
-
-def t_FLOAT(t):
-    r'[0-9]?\.[0-9]*'
-    t.value = float(t.value)
-    return t
-
-
-def t_STRING(t):
-    r'"([^"]|\\")*"'
-    t.value = t.value[1:-1]
-    return t
-
-
-def t_newline(t):
-    r'\n+'
-    t.lexer.lineno += t.value.count("\n")
-
-
-def t_error(t):
-    raise LexicalError("Lexical error at %r line %d" % (t.value, t.lineno))
-
-
-def p_content_empty(p):
-    r'content :'
-    p[0] = {}
-
-
-def p_content(p):
-    r'content : content entry'
-    p[0] = dict(p[1])
-    p[0].update(p[2])
-
-
-def p_value(p):
-    r'''
-    value : IPADDR
-          | DOMAIN
-          | MACADDR
-          | STRING
-          | INTEGER
-          | FLOAT
-          | NAME
-          | CIDR4
-    '''
-    p[0] = p[1]
-
-
-def p_value_list_start(p):
-    r'''value_list : value COMMA value'''
-    p[0] = [p[1], p[3]]
-
-
-def p_value_list(p):
-    r'''value_list : value_list COMMA value'''
-    p[0] = p[1] + [p[3]]
-
-
-def p_key_part(p):
-    r'''
-    key_part : NAME
-             | DOMAIN
-             | IPADDR
-             | MACADDR
-             | STRING
-             | INTEGER
-             | FLOAT
-             | CIDR4
-    '''
-    p[0] = p[1]
-
-
-def p_key_single(p):
-    r'key : key_part'
-    p[0] = p[1]
-
-
-def p_key(p):
-    r'key : key key_part'
-    if p[1] == 'device':
-        p[0] = p[1] + '-' + p[2]
-    else:
-        p[0] = p[1]
-
-
-def p_entry(p):
-    r'''
-    entry : key value SEMICOLON
-          | key value_list SEMICOLON
-          | key block
-          | key block SEMICOLON
-    '''
-    p[0] = {p[1]: p[2]}
-
-
-def p_entry_nokey(p):
-    r'''
-    entry : value SEMICOLON
-    '''
-    p[0] = {(): p[1]}
-
-
-def p_block(p):
-    r'block : BRACE_OPEN content BRACE_CLOSE'
-    p[0] = p[2]
-
-
-def p_error(p):
-    if p:
-        raise SyntaxError("Syntax error at %r line %d" % (p.value, p.lineno))
-    else:
-        raise SyntaxError("Syntax error")
+_TOKEN = re.compile(r'''
+    (?P<skip>[ \t\r=]+|\#.*)
+  | "(?P<str>(?:[^"\\\n]|\\.)*)"
+  | (?P<punct>[{};,])
+  | (?P<word>[^\s=;,{}"\#]+)
+  | (?P<bad>.)
+''', re.VERBOSE)
+_INTEGER = re.compile(r'-?[0-9]+$')
+_FLOAT = re.compile(r'-?(?:[0-9]+\.[0-9]*|\.[0-9]+)$')
+_MACADDR = re.compile(r'(?:[0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2}$')
+_ESCAPE = re.compile(r'\\(["\\])')
+
+_EOF = ('eof', None, 0, 0)
+
+
+def _word_value(word):
+    if _INTEGER.match(word):
+        return int(word)
+    if _FLOAT.match(word):
+        return float(word)
+    if _MACADDR.match(word):
+        return word.lower()
+    return word
+
+
+def _tokens(lines):
+    """Generate (kind, value, line, column) tuples
+
+    kind is one of '{', '}', ';', ',', 'nl', 'value' or 'eof'
+    """
+    lineno = 0
+    for line in lines:
+        lineno += 1
+        for m in _TOKEN.finditer(line.rstrip('\n')):
+            kind = m.lastgroup
+            if kind == 'skip':
+                continue
+            if kind == 'word':
+                yield ('value', _word_value(m.group('word')),
+                       lineno, m.start() + 1)
+            elif kind == 'str':
+                yield ('value', _ESCAPE.sub(r'\1', m.group('str')),
+                       lineno, m.start() + 1)
+            elif kind == 'punct':
+                yield (m.group('punct'), None, lineno, m.start() + 1)
+            else:
+                raise LexicalError('Lexical error at {0!r} line {1} column {2}'
+                                   .format(line[m.start():].rstrip('\n'),
+                                           lineno, m.start() + 1))
+        yield ('nl', None, lineno, len(line))
+    yield _EOF
+
+
+class _Parser:
+
+    def __init__(self, lines):
+        self.tokens = _tokens(lines)
+        self.tok = next(self.tokens)
+
+    def advance(self):
+        tok = self.tok
+        if tok is not _EOF:
+            self.tok = next(self.tokens)
+        return tok
+
+    def error(self, tok):
+        kind, value, line, col = tok
+        if kind == 'eof':
+            raise SyntaxError('Syntax error at end of file, missing }?')
+        if kind == 'nl':
+            what = 'end of line'
+        else:
+            what = repr(value if kind == 'value' else kind)
+        raise SyntaxError('Syntax error at {0} line {1} column {2}'
+                          .format(what, line, col))
+
+    def content(self, depth):
+        """Parse entries up to a closing brace, or the end of file"""
+        result = dict()
+        while True:
+            kind = self.tok[0]
+            if kind in ('nl', ';'):
+                self.advance()
+            elif kind == 'value':
+                self.entry(result)
+            elif kind == '}' and depth > 0:
+                self.advance()
+                return result
+            elif kind == 'eof' and depth == 0:
+                return result
+            else:
+                self.error(self.tok)
+
+    def entry(self, result):
+        parts = []
+        while self.tok[0] == 'value':
+            parts.append(self.advance()[1])
+        kind = self.tok[0]
+
+        if kind == '{':
+            self.advance()
+            result[self.key(parts)] = self.content(1)
+            return
+
+        if kind == ',':
+            if len(parts) < 2:
+                self.error(self.tok)
+            values = [parts[-1]]
+            while self.tok[0] == ',':
+                self.advance()
+                if self.tok[0] != 'value':
+                    self.error(self.tok)
+                values.append(self.advance()[1])
+            value = values
+            kind = self.tok[0]
+        elif len(parts) == 1:
+            # a value without a key
+            result[()] = parts[0]
+            return
+        else:
+            value = parts[-1]
+
+        if kind not in ('nl', ';', '}', 'eof'):
+            self.error(self.tok)
+        result[self.key(parts[:-1])] = value
+
+    def key(self, parts):
+        if not parts:
+            self.error(self.tok)
+        if parts[0] == 'device' and len(parts) > 1:
+            return 'device-{0}'.format(parts[1])
+        return parts[0]
+
+
+def parse_lines(lines, devices=False):
+    """Parse a config from an iterable of lines, such as an open file
+
+    :param lines: iterable of lines
+    :param devices: move the top level ``device-<uid>`` blocks into a
+        ``devices`` dict keyed by uid, setting each one's ``uid``
+    :returns: the config as nested dicts
+    :rtype: dict
+    :raises Error: SyntaxError or LexicalError, with line and column
+    """
+    config = _Parser(lines).content(0)
+    if not devices:
+        return config
+
+    result = dict()
+    devs = dict()
+    for key, value in config.items():
+        if isinstance(key, str) and key.startswith('device-'):
+            uid = key[7:]
+            value['uid'] = uid
+            devs[uid] = value
+        else:
+            result[key] = value
+    result['devices'] = devs
+    return result
 
 
 def parse(string):
-    return ply.yacc.parse(string)
-
-
-ply.lex.lex(debug=0)
-ply.yacc.yacc(debug=0)
+    """Parse a config string
+
+    :param string: config text
+    :returns: the config as nested dicts
+    :rtype: dict
+    :raises Error: SyntaxError or LexicalError, with line and column
+    """
+    return parse_lines(string.splitlines())
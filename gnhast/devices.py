@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+.. module:: devices
+Device storage for gnhast
+"""
+
+from collections.abc import MutableMapping
+
+
+# Field order matches the old gnhast.DEVICE template dict
+DEVICE_FIELDS = (
+    'uid', 'loc', 'name', 'rrdname',
+    'proto', 'type', 'subtype',
+    'scale',
+    'data', 'last', 'min', 'max', 'avg',
+    'lowat', 'hiwat', 'change',
+    'handler', 'hargs', 'tags',
+    'localdata',
+    'lastupd',
+    'spamhandler'
+)
+_FIELDSET = frozenset(DEVICE_FIELDS)
+
+
+class Device(MutableMapping):
+    """A gnhast device.
+
+    A compact replacement for deep copies of the ``gnhast.DEVICE`` template
+    dict.  The standard fields live in ``__slots__`` and are available as
+    attributes (``dev.data``), while the object still behaves as a mutable
+    mapping so code doing ``dev['data']`` keeps working.  Keys outside the
+    standard set (config file options such as ``tscale``) are kept in a
+    side dict that is only created when first needed, as are ``hargs`` and
+    ``tags``.
+    """
+
+    __slots__ = ('uid', 'loc', 'name', 'rrdname',
+                 'proto', 'type', 'subtype',
+                 'scale',
+                 'data', 'last', 'min', 'max', 'avg',
+                 'lowat', 'hiwat', 'change',
+                 'handler', '_hargs', '_tags',
+                 'localdata',
+                 'lastupd',
+                 'spamhandler',
+                 '_extra')
+
+    def __init__(self, uid='', name='', type=0, subtype=0, **kwargs):
+        self.uid = uid
+        self.loc = ''
+        self.name = name
+        self.rrdname = ''
+        self.proto = 0
+        self.type = type
+        self.subtype = subtype
+        self.scale = 0
+        self.data = 0
+        self.last = 0
+        self.min = 0
+        self.max = 0
+        self.avg = 0
+        self.lowat = 0
+        self.hiwat = 0
+        self.change = 0
+        self.handler = 0
+        self._hargs = None
+        self._tags = None
+        self.localdata = None
+        self.lastupd = 0
+        self.spamhandler = 0
+        self._extra = None
+        for key, value in kwargs.items():
+            self[key] = value
+
+    @property
+    def hargs(self):
+        if self._hargs is None:
+            self._hargs = dict()
+        return self._hargs
+
+    @hargs.setter
+    def hargs(self, value):
+        self._hargs = value
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = dict()
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        self._tags = value
+
+    def __getitem__(self, key):
+        if key in _FIELDSET:
+            return getattr(self, key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _FIELDSET:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = dict()
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _FIELDSET:
+            raise KeyError('cannot delete device field {0}'.format(key))
+        if self._extra is None or key not in self._extra:
+            raise KeyError(key)
+        del self._extra[key]
+
+    def __contains__(self, key):
+        if key in _FIELDSET:
+            return True
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        yield from DEVICE_FIELDS
+        if self._extra is not None:
+            yield from list(self._extra)
+
+    def __len__(self):
+        if self._extra is None:
+            return len(DEVICE_FIELDS)
+        return len(DEVICE_FIELDS) + len(self._extra)
+
+    def __repr__(self):
+        return 'Device({0!r})'.format(dict(self.items()))
+
+
+class DeviceRegistry:
+    """Ordered device table, indexed by uid.
+
+    Behaves like the plain list gnhast used to keep in ``gnhast.devices``
+    (iteration, len(), append()), but every device is also indexed by its
+    uid, so lookups and removals are O(1).  Adding a device whose uid is
+    already present replaces the old entry in place instead of duplicating
+    it.
+
+    ``history`` is an optional gnhast.history.HistoryStore of the readings
+    of the devices, kept in step when devices are removed or renamed.
+    """
+
+    def __init__(self, devices=()):
+        self._byuid = dict()
+        self.history = None
+        for dev in devices:
+            self.add(dev)
+
+    def add(self, dev):
+        """Add a device, replacing any existing device with the same uid
+
+        :param dev: device to add
+        :returns: the device that was added
+        :rtype: dict
+        """
+        self._byuid[dev['uid']] = dev
+        return dev
+
+    # list compatibility, collectors call gn.devices.append(dev)
+    append = add
+
+    def find(self, uid):
+        """Look up a device by uid
+
+        :param uid: uid to search for
+        :returns: device dict or None
+        :rtype: dict
+        """
+        return self._byuid.get(uid)
+
+    def remove(self, dev):
+        """Remove a device from the table
+
+        :param dev: device, or uid of the device, to remove
+        :returns: the removed device or None if it was not present
+        :rtype: dict
+        """
+        uid = dev if isinstance(dev, str) else dev['uid']
+        if self.history is not None:
+            self.history.remove(uid)
+        return self._byuid.pop(uid, None)
+
+    def reindex(self, dev, olduid):
+        """Move a device to a new uid after its uid was changed in place
+
+        :param dev: the device, already carrying its new uid
+        :param olduid: the uid the device was registered under
+        :returns: the device
+        :rtype: dict
+        """
+        if self._byuid.get(olduid) is dev:
+            del self._byuid[olduid]
+            if self.history is not None:
+                self.history.rename(olduid, dev['uid'])
+        return self.add(dev)
+
+    def uids(self):
+        """All registered uids, in insertion order"""
+        return self._byuid.keys()
+
+    def clear(self):
+        self._byuid.clear()
+        if self.history is not None:
+            self.history.clear()
+
+    def __contains__(self, item):
+        if isinstance(item, str):
+            return item in self._byuid
+        return self._byuid.get(item['uid']) is item
+
+    def __iter__(self):
+        return iter(list(self._byuid.values()))
+
+    def __len__(self):
+        return len(self._byuid)
+
+    def __getitem__(self, index):
+        return list(self._byuid.values())[index]
+
+    def __repr__(self):
+        return 'DeviceRegistry({0!r})'.format(list(self._byuid.values()))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+.. module:: dispatch
+Concurrent callback execution for gnhast
+"""
+
+import asyncio
+from collections import deque
+import time
+
+
+class CallbackRunner:
+    """Runs callbacks as tasks, in order per key, in parallel across keys.
+
+    Jobs submitted under the same key (a device uid) run one after the
+    other, in submission order.  Jobs for different keys run concurrently,
+    at most ``limit`` at a time.  submit() never blocks, so the caller
+    (the gnhastd listener) is never held up by a slow callback.
+
+    ``depth`` is the number of jobs submitted but not finished yet, and
+    latency is measured from submit() to the end of the job.
+    """
+
+    def __init__(self, limit=16):
+        self.limit = limit
+        self.on_error = None
+        self.depth = 0
+        self.max_depth = 0
+        self.completed = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._queues = dict()
+        self._tasks = set()
+        self._sem = None
+
+    def submit(self, key, func, *args):
+        """Schedule await func(*args) behind earlier jobs for key
+
+        :param key: ordering key, such as a device uid
+        :param func: coroutine function
+        :param args: its arguments
+        """
+        job = (func, args, time.monotonic())
+        self.depth += 1
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(job)
+            return
+        self._queues[key] = deque([job])
+        task = asyncio.ensure_future(self._drain(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key):
+        queue = self._queues[key]
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.limit)
+        try:
+            while queue:
+                func, args, submitted = queue[0]
+                async with self._sem:
+                    try:
+                        await func(*args)
+                    except Exception as e:
+                        self.failed += 1
+                        if self.on_error is not None:
+                            self.on_error(func, e)
+                queue.popleft()
+                self.depth -= 1
+                self.completed += 1
+                latency = time.monotonic() - submitted
+                self.latency_total += latency
+                if latency > self.latency_max:
+                    self.latency_max = latency
+        finally:
+            # only left non-empty if we were cancelled
+            self.depth -= len(queue)
+            del self._queues[key]
+
+    async def join(self):
+        """Wait until every submitted job has finished"""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def stats(self):
+        """Queue depth and latency counters
+
+        :returns: depth, max_depth, running (keys with jobs), completed,
+            failed, latency_avg and latency_max in seconds
+        :rtype: dict
+        """
+        avg = self.latency_total / self.completed if self.completed else 0.0
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'running': len(self._queues),
+            'completed': self.completed,
+            'failed': self.failed,
+            'latency_avg': avg,
+            'latency_max': self.latency_max,
+        }
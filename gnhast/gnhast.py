@@ -5,17 +5,26 @@ Gnhast
 """
 
 import asyncio
-from gnhast import confuseparse
+from gnhast.devices import Device, DeviceRegistry
+from gnhast.alarms import AlarmTable
+from gnhast import protocol
+from gnhast.outqueue import CoalescingQueue
+from gnhast import units
+from gnhast.logwriter import LogWriter
+from gnhast.subscriptions import SubscriptionRegistry
+from gnhast.dispatch import CallbackRunner
+from gnhast.stats import StatsTable
+from gnhast.history import HistoryStore
+from gnhast.columnar import DeviceRow
 from pprint import pprint
 import time
-from datetime import datetime
-from pint import UnitRegistry
 from flags import Flags
-import shlex
 import functools
 import signal
-import re
-import copy
+import os
+import stat
+import random
+from collections import deque
 import sys
 
 # Todo:
@@ -25,6 +34,12 @@ LOG_INFO = 0
 LOG_ERROR = 1
 LOG_WARNING = 2
 LOG_DEBUG = 3
+LOG_LEVELS = {
+    LOG_INFO: 'INFO',
+    LOG_ERROR: 'ERROR',
+    LOG_WARNING: 'WARNING',
+    LOG_DEBUG: 'DEBUG',
+}
 
 
 class AlarmChan(Flags):
@@ -50,6 +65,140 @@ class AlarmChan(Flags):
     ALL = -1
 
 
+def _write_if_changed(path, data):
+    """Atomically replace path with data, unless it already holds data
+
+    A symlink is followed, so the file it points to is replaced, and the
+    new file keeps the mode and, where we are allowed to set it, the owner
+    of the old one.
+    """
+    path = os.path.realpath(path)
+    st = None
+    try:
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if f.read() == data:
+                return False
+    except OSError:
+        pass
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if st is not None:
+            if hasattr(os, 'chown'):
+                try:
+                    os.chown(tmp, st.st_uid, st.st_gid)
+                except OSError:
+                    # only root may give a file away
+                    pass
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    # make the rename itself durable
+    try:
+        fd = os.open(os.path.dirname(path), os.O_RDONLY)
+    except OSError:
+        return True
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+    return True
+
+
+class _Batch:
+    """Async context manager returned by gnhast.gn_batch()"""
+
+    def __init__(self, gn):
+        self.gn = gn
+
+    async def __aenter__(self):
+        self.gn.gn_cork()
+        return self.gn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.gn.gn_uncork()
+
+
+class _LdevsSlot:
+    """One ldevs request waiting for its endldevs
+
+    gnhastd answers ldevs requests in order, so gnhast._ldevs_queues holds
+    a slot for every request sent, oldest first.  The devices listed go to
+    the queue of the slot at the head; a slot without a queue (a request
+    sent by gn_ldevs(), or a listing nobody reads any more) drops them.
+    """
+
+    __slots__ = ('queue',)
+
+    def __init__(self, queue=None):
+        self.queue = queue
+
+
+class _Ldevs:
+    """Returned by gnhast.gn_list_devices()
+
+    Iterate over it with async for to send the ldevs request and get each
+    device as gnhastd lists it.
+    """
+
+    def __init__(self, gn, cmd, timeout):
+        self.gn = gn
+        self.cmd = cmd
+        self.timeout = timeout
+        self._slot = None
+
+    async def _send(self, queue):
+        self._slot = _LdevsSlot(queue)
+        self.gn._ldevs_queues.append(self._slot)
+        try:
+            await self.gn.gn_send(self.cmd, 'gn_ldevs')
+        except BaseException:
+            self.gn._ldevs_queues.remove(self._slot)
+            raise
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._slot is None:
+            await self._send(asyncio.Queue())
+        queue = self._slot.queue
+        if queue is None:
+            raise StopAsyncIteration
+        try:
+            if self.timeout is None:
+                item = await queue.get()
+            else:
+                item = await asyncio.wait_for(queue.get(), self.timeout)
+        except BaseException:
+            # timed out or cancelled, let the rest of the listing drain
+            self._slot.queue = None
+            raise
+        if item is None:
+            self._slot.queue = None
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            self._slot.queue = None
+            raise item
+        return item
+
+    async def aclose(self):
+        """Stop iterating, the rest of the listing is dropped"""
+        if self._slot is not None:
+            self._slot.queue = None
+
+
 class gnhast:
     """ The main gnhast class.
     """
@@ -58,17 +207,12 @@ class gnhast:
         self.cfg = cfgfile
         # self.loop = asyncio.get_event_loop()
         self.loop = loop
-        self.devices = []
-        self.alarms = []
+        self.devices = DeviceRegistry()
+        self.alarms = AlarmTable()
         self.instance = 1
-        self.arg_by_subt = [ "none", "switch", "switch", "temp", "humid",
-                             "count", "pres", "speed", "dir", "ph", "wet",
-                             "hub", "lux", "volts", "wsec", "watt", "amps",
-                             "rain", "weather", "alarm", "number", "pct",
-                             "flow", "distance", "volume", "timer",
-                             "thmode", "thstate", "smnum", "blind",
-                             "collector", "trigger", "orp", "salinity",
-                             "daylight", "moonph", "tristate" ]
+        # encode and decode tables for protocol words, see protocol.py
+        self.arg_by_subt = list(protocol.DATA_WORDS)
+        self.word_map = protocol.build_word_map()
 
         self.proto_map = [ 'NONE', 'insteon-v1', 'insteon-v2', 'insteon-v2cs',
                            'sensor-owfs', 'brultech-gem', 'brultech-ecm1240',
@@ -86,6 +230,7 @@ class gnhast:
                            'waterheater', 'light', 'av', 'thermostat',
                            'settings', 'blind' ]
         
+        # Template of the fields every device carries, see devices.Device
         self.DEVICE = {
             'uid': '', 'loc': '', 'name': '', 'rrdname': '',
             'proto': 0, 'type': 0, 'subtype': 0,
@@ -109,18 +254,70 @@ class gnhast:
             'timer', 'thmode', 'thstate', 'smnumber', 'blind',
             'collector', 'trigger', 'orp', 'salinity', 'daylight',
             'moonph', 'tristate', 'bool']
-        self.cf_tscale = ['f', 'c', 'k', 'r']
-        self.cf_speedscale = ['mph', 'ms', 'kph', 'knots']
-        self.cf_lengthscale = ['in', 'mm']
-        self.cf_baroscale = ['in', 'mm', 'mb', 'cb']
-        self.cf_lightscale = ['wm2', 'lux']
-        self.cf_salinescale = ['ppt', 'sg', 'ms']
+        self.cf_tscale = list(units.TSCALE)
+        self.cf_speedscale = list(units.SPEEDSCALE)
+        self.cf_lengthscale = list(units.LENGTHSCALE)
+        self.cf_baroscale = list(units.BAROSCALE)
+        self.cf_lightscale = list(units.LIGHTSCALE)
+        self.cf_salinescale = list(units.SALINESCALE)
 
         self.collector_healthy = True
         self.debug = False
         self.writer = None
         self.reader = None
+        # write batching, see gn_batch()
+        self.batch_maxbytes = 65536
+        self.batch_maxdelay = 0.05
+        self._batch_depth = 0
+        self._wbuf = []
+        self._wbuf_size = 0
+        self._wbuf_timer = None
+        # uid -> (key, encoded upd prefix), see gn_update_devices()
+        self._upd_cache = dict()
+
+        # client side update suppression, see gn_suppress_update()
+        self.suppressed = dict()
+        self._sendstate = dict()
+
+        # reconnect handling, see gn_connfail()
+        self.reconnect = False
+        self.reconnect_min = 0.1
+        self.reconnect_max = 30.0
+        # a connection that lasts this long resets the backoff
+        self.reconnect_stable = 10.0
+        self.connect_timeout = 10.0
+        self.pending_max = 1000
+        self.pending_dropped = 0
+        self.connected = False
+        self.gnhastd_addr = None
+        self._closing = False
+        self._pending = deque()
+        self._replay = dict()
+        self._reconnect_task = None
+        self._reconnect_delay = None
+        self._connected_at = None
+
+        # latest-value-wins outbound queue, see gn_send()
+        self.coalesce = False
+        self.outq = CoalescingQueue()
+        self._outq_event = None
+        self._outq_task = None
         self.log = sys.stderr
+        # hand log lines to a writer thread instead of printing them
+        self.log_async = True
+        self._logwriter = LogWriter()
+        # rate limited warnings, see LOG_WARNING_LIMITED()
+        self.log_limit_interval = 60.0
+        self.log_counts = dict()
+
+        # parsed config cache, see parse_cfg().  None disables it, True
+        # keeps the cache next to the config file, a string names a
+        # directory to keep it in.
+        self.cfg_cache = None
+        # write-behind for write_conf_file(), in seconds, None disables
+        self.conf_write_delay = None
+        self._conf_pending = None
+        self._conf_timer = None
 
         self.ALARM = {
             'aluid': '',
@@ -132,6 +329,34 @@ class gnhast:
         self.coll_upd_cb = None
         self.coll_reg_cb = None
         self.coll_chg_cb = None
+        # per device callbacks, see subscribe()
+        self.subscriptions = SubscriptionRegistry()
+        # run device callbacks as tasks instead of inline in the listener,
+        # see int_coll_upd_cb() and self.callback_runner.stats()
+        self.concurrent_callbacks = False
+        self.callback_runner = CallbackRunner()
+        self.callback_runner.on_error = self._callback_failed
+        # run plain (non-async) callbacks in a pool of this many threads,
+        # 0 calls them on the event loop
+        self.callback_threads = 0
+        self._callback_pool = None
+        # requests waiting for a reply, see gn_ask() and gn_list_devices()
+        self._asks = dict()
+        self._ldevs_queues = deque()
+        # keep the min, max, avg and change fields of devices up to date,
+        # see gn_track_stats()
+        self.track_stats = False
+        self.stats = StatsTable()
+
+        # inbound command verb -> handler
+        self.cmd_handlers = {
+            'reg': self.command_reg,
+            'upd': self.command_upd,
+            'chg': self.command_chg,
+            'endldevs': self.command_endldevs,
+            'ping': self.command_ping,
+            'setalarm': self.command_setalarm,
+        }
 
     def parse_convert_to_int(self, value, ptype):
         """Convert a parsed string to it's correct type
@@ -150,68 +375,145 @@ class gnhast:
         except ValueError:
             return -1
 
-    def print_convert(self, key, val, outfile):
+    def format_convert(self, key, val):
+        """Format one device option as a config file line
+
+        :param key: option name
+        :param val: option value, as stored in the device
+        :returns: the line, without a newline
+        :rtype: str
+
+        """
         if key == 'type':
-            print('  ' + key + ' = ' + self.cf_type[val], file=outfile)
+            return '  ' + key + ' = ' + self.cf_type[val]
         elif key == 'subtype':
-            print('  ' + key + ' = ' + self.cf_subt[val], file=outfile)
+            return '  ' + key + ' = ' + self.cf_subt[val]
         elif key == 'tscale':
-            print('  ' + key + ' = ' + self.cf_tscale[val], file=outfile)
+            return '  ' + key + ' = ' + self.cf_tscale[val]
         elif key == 'speedscale':
-            print('  ' + key + ' = ' + self.cf_speedscale[val], file=outfile)
+            return '  ' + key + ' = ' + self.cf_speedscale[val]
         elif key == 'lengthscale':
-            print('  ' + key + ' = ' + self.cf_lengthscale[val], file=outfile)
+            return '  ' + key + ' = ' + self.cf_lengthscale[val]
         elif key == 'baroscale':
-            print('  ' + key + ' = ' + self.cf_baroscale[val], file=outfile)
+            return '  ' + key + ' = ' + self.cf_baroscale[val]
         elif key == 'lightscale':
-            print('  ' + key + ' = ' + self.cf_lightscale[val], file=outfile)
+            return '  ' + key + ' = ' + self.cf_lightscale[val]
         elif key == 'salinescale':
-            print('  ' + key + ' = ' + self.cf_salinescale[val], file=outfile)
+            return '  ' + key + ' = ' + self.cf_salinescale[val]
+        elif key == 'spamhandler':
+            return '  ' + key + ' = ' + self.cf_spamhandler[val]
         elif isinstance(val, str):
-            print('  ' + key + ' = ' + '"' + val + '"', file=outfile)
+            return '  ' + key + ' = ' + '"' + val + '"'
         else:
-            print('  ' + key + ' = ' + str(val), file=outfile)
+            return '  ' + key + ' = ' + str(val)
 
-    def write_conf_file(self, conffile):
-        """Write out a config file
+    def print_convert(self, key, val, outfile):
+        print(self.format_convert(key, val), file=outfile)
 
-        :param conffile: full path to config file to create
-        :returns: None
-        :rtype: None
+    def render_conf(self):
+        """Render the current config, with current device data, as text
+
+        :returns: the config file contents
+        :rtype: str
 
         """
-        if conffile == '':
-            return
-        f = open(conffile, 'w')
+        skip = ('data', 'avg', 'min', 'max', 'lastupd', 'last', 'change')
+        out = []
 
         # overwrite our config data with current data
         for dev in self.devices:
-            self.config['devices'][dev['uid']] = dev
+            entry = self.config['devices'].get(dev['uid'])
+            if isinstance(dev, DeviceRow) and isinstance(entry, dict):
+                # a columnar row has every field, only refresh the options
+                # the config file set
+                for key in entry:
+                    entry[key] = dev[key]
+            else:
+                self.config['devices'][dev['uid']] = dev
 
         for toplvl in self.config:
             if toplvl == 'devices':
-                for dev in self.config[toplvl]:
-                    print('device "' + self.config['devices'][dev]['uid'] + '" {', file=f)
-                    for val in self.config['devices'][dev]:
-                        if val != 'data' and val != 'avg' and val != 'min' \
-                           and val != 'max' and val != 'lastupd' \
-                           and val != 'last' and val != 'change':
-                            self.print_convert(val, self.config['devices'][dev][val], f)
-                    print('}', file=f)
+                for dev in self.config[toplvl].values():
+                    out.append('device "' + dev['uid'] + '" {')
+                    for val in dev:
+                        if val not in skip:
+                            out.append(self.format_convert(val, dev[val]))
+                    out.append('}')
             elif isinstance(self.config[toplvl], dict):
-                print(toplvl + ' {', file=f)
-                for part in self.config[toplvl]:
-                    if isinstance(self.config[toplvl][part], str):
-                        print('  ' + part + ' = "' + self.config[toplvl][part] + '"', file=f)
+                out.append(toplvl + ' {')
+                for part, value in self.config[toplvl].items():
+                    if isinstance(value, str):
+                        out.append('  ' + part + ' = "' + value + '"')
                     else:
-                        print('  ' + part + ' = ' + str(self.config[toplvl][part]), file=f)
-                print('}', file=f)
+                        out.append('  ' + part + ' = ' + str(value))
+                out.append('}')
             else:
                 if isinstance(self.config[toplvl], str):
-                    print(toplvl + ' = "' + self.config[toplvl] + '"', file=f)
+                    out.append(toplvl + ' = "' + self.config[toplvl] + '"')
                 else:
-                    print(toplvl + ' = ' + str(self.config[toplvl]), file=f)
-        f.close()
+                    out.append(toplvl + ' = ' + str(self.config[toplvl]))
+        out.append('')
+        return '\n'.join(out)
+
+    def write_conf_file(self, conffile):
+        """Write out a config file
+
+        The file is rendered in memory, written to a temporary file next
+        to conffile, fsynced and renamed over it, so a crash never leaves
+        a truncated config.  Nothing is written if the file on disk
+        already holds the same contents.
+
+        If self.conf_write_delay is set and an event loop is running, the
+        write is deferred instead: calls within conf_write_delay seconds
+        of each other are folded into one write, rendered when the delay
+        expires and written from an executor thread.  See gn_flush_conf().
+
+        :param conffile: full path to config file to create
+        :returns: True if the file was written, False if it was unchanged
+            or the write was deferred
+        :rtype: bool
+
+        """
+        if conffile == '':
+            return False
+        if self.conf_write_delay is not None:
+            try:
+                loop = asyncio.get_event_loop()
+                running = loop.is_running()
+            except RuntimeError:
+                running = False
+            if running:
+                self._conf_pending = conffile
+                if self._conf_timer is None:
+                    self._conf_timer = loop.call_later(
+                        self.conf_write_delay,
+                        lambda: asyncio.ensure_future(self.gn_flush_conf()))
+                return False
+        return _write_if_changed(conffile, self.render_conf().encode())
+
+    async def gn_flush_conf(self):
+        """Write out a config file deferred by write_conf_file() now
+
+        :returns: True if the file was written
+        :rtype: bool
+
+        """
+        if self._conf_timer is not None:
+            self._conf_timer.cancel()
+            self._conf_timer = None
+        conffile = self._conf_pending
+        if conffile is None:
+            return False
+        self._conf_pending = None
+        data = self.render_conf().encode()
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(None, _write_if_changed,
+                                              conffile, data)
+        except OSError as error:
+            self.LOG_ERROR('Cannot write config file {0}: {1}'.format(
+                conffile, error))
+            return False
 
     def new_device(self, uid, name, type, subtype):
         """Create a new device and insert it to the device table
@@ -220,84 +522,112 @@ class gnhast:
         :param name: Device Name
         :param type: Device type (int)
         :param subtype: Device subtype (int)
-        :returns: new device, appended to device list
-        :rtype: dict
+        :returns: new device, added to the device table
+        :rtype: Device
 
         """
-        dev = copy.deepcopy(self.DEVICE)
-        dev['name'] = name
-        dev['type'] = type
-        dev['uid'] = uid
-        dev['subtype'] = subtype
-        self.devices.append(dev)
-        return dev
+        return self.devices.add(Device(uid, name, type, subtype))
 
     def parse_cfg(self):
         """Parse a config file
 
+        If self.cfg_cache is set, the parsed config is cached, and reused
+        for as long as the config file and the conversion tables stay the
+        same.  A missing, stale or unreadable cache just means a normal
+        parse.
+
         :returns: Configuration dict
         :rtype: dict
 
         """
-        modcfg = ''
-        with open(self.cfg, "r") as f:
-            for line in f:
-                x = line.rstrip()
-                if not x.endswith('{') and not x == '':
-                    x += ';'
-                modcfg += x + '\n'
+        if self.cfg_cache is None or self.cfg_cache is False:
+            return self._parse_cfg_file()
+
+        from gnhast import cfgcache
+
+        cachedir = None if self.cfg_cache is True else self.cfg_cache
+        path = cfgcache.cache_path(self.cfg, cachedir)
+        try:
+            key = cfgcache.fingerprint(self.cfg, self._cfg_tables())
+        except OSError:
+            # let the normal parse report it
+            return self._parse_cfg_file()
+
+        config = cfgcache.load(path, key)
+        if config is not None:
+            self.LOG_DEBUG('Using cached config {0}', path)
+            self.config = config
+            for x in self.config['devices'].values():
+                self.devices.add(x)
+            return self.config
+
+        self._parse_cfg_file()
         try:
-            self.config = confuseparse.parse(modcfg)
-        except Exception as error:
+            cfgcache.store(path, key, self.config)
+        except (OSError, ValueError) as error:
+            self.LOG_WARNING('Cannot write config cache {0}: {1}'.format(
+                path, error))
+        return self.config
+
+    def _cfg_tables(self):
+        """The conversion tables parse_cfg() translates devices with"""
+        return (self.proto_map, self.cf_type, self.cf_subt, self.cf_tscale,
+                self.cf_speedscale, self.cf_lengthscale, self.cf_baroscale,
+                self.cf_lightscale, self.cf_salinescale, self.cf_spamhandler)
+
+    def _parse_cfg_file(self):
+        from gnhast import confuseparse
+
+        try:
+            with open(self.cfg, "r") as f:
+                self.config = confuseparse.parse_lines(f, devices=True)
+        except confuseparse.Error as error:
             self.LOG_ERROR('{0}'.format(error))
             exit(1)
 
-        # Now look for device-* entries and reform them
-        self.config.update({'devices': dict()})
-        devpat = re.compile("^device-(.*)")
-        keylist = []
-        for key, value in self.config.items():
-            if devpat.match(key):
-                m = devpat.match(key)
-                self.config['devices'][m.group(1)] = value
-                self.config['devices'][m.group(1)]['uid'] = m.group(1)
-                # Now convert the entries
-                x = self.config['devices'][m.group(1)]
-                x['proto'] = self.parse_convert_to_int(x['proto'],
-                                                       self.proto_map)
-                x['type'] = self.parse_convert_to_int(x['type'], self.cf_type)
-                if 'subtype' in x:
-                    x['subtype'] = self.parse_convert_to_int(x['subtype'],
-                                                             self.cf_subt)
-                if 'tscale' in x:
-                    x['tscale'] = self.parse_convert_to_int(x['tscale'],
-                                                            self.cf_tscale)
-                if 'speedscale' in x:
-                    x['speedscale'] = self.parse_convert_to_int(x['speedscale'],
-                                                                self.cf_speedscale)
-                if 'lengthscale' in x:
-                    x['lengthscale'] = self.parse_convert_to_int(x['lengthscale'],
-                                                                 self.cf_lengthscale)
-                if 'baroscale' in x:
-                    x['baroscale'] = self.parse_convert_to_int(x['baroscale'],
-                                                               self.cf_baroscale)
-                if 'lightscale' in x:
-                    x['lightscale'] = self.parse_convert_to_int(x['lightscale'],
-                                                                self.cf_lightscale)
-                if 'salinescale' in x:
-                    x['salinescale'] = self.parse_convert_to_int(x['salinescale'],
-                                                                 self.cf_salinescale)
-                keylist.append(key)
-                # While we are here, append them to the internal devices list
-                self.devices.append(self.config['devices'][m.group(1)])
-
-        for key in keylist:
-            del self.config[key]
+        # Now convert the device entries
+        for x in self.config['devices'].values():
+            x['proto'] = self.parse_convert_to_int(x['proto'],
+                                                   self.proto_map)
+            x['type'] = self.parse_convert_to_int(x['type'], self.cf_type)
+            if 'subtype' in x:
+                x['subtype'] = self.parse_convert_to_int(x['subtype'],
+                                                         self.cf_subt)
+            if 'tscale' in x:
+                x['tscale'] = self.parse_convert_to_int(x['tscale'],
+                                                        self.cf_tscale)
+            if 'speedscale' in x:
+                x['speedscale'] = self.parse_convert_to_int(x['speedscale'],
+                                                            self.cf_speedscale)
+            if 'lengthscale' in x:
+                x['lengthscale'] = self.parse_convert_to_int(x['lengthscale'],
+                                                             self.cf_lengthscale)
+            if 'baroscale' in x:
+                x['baroscale'] = self.parse_convert_to_int(x['baroscale'],
+                                                           self.cf_baroscale)
+            if 'lightscale' in x:
+                x['lightscale'] = self.parse_convert_to_int(x['lightscale'],
+                                                            self.cf_lightscale)
+            if 'salinescale' in x:
+                x['salinescale'] = self.parse_convert_to_int(x['salinescale'],
+                                                             self.cf_salinescale)
+            if 'spamhandler' in x:
+                x['spamhandler'] = self.parse_convert_to_int(x['spamhandler'],
+                                                             self.cf_spamhandler)
+            # While we are here, add them to the internal device table
+            self.devices.add(x)
 
         # if self.debug:
         #     pprint(self.config)
         return self.config
 
+    def _temp_scale(self, scale):
+        # index of a temperature scale, given by name or int
+        idx = self.parse_convert_to_int(scale, self.cf_tscale)
+        if not 0 <= idx < len(units.TSCALE):
+            raise ValueError('unknown temperature scale {0!r}'.format(scale))
+        return idx
+
     def gn_scale_temp(self, temp, curscale, newscale):
         """Rescale a temperature
 
@@ -306,77 +636,101 @@ class gnhast:
         :param newscale: new scale (string or int)
         :returns: temperature in new scale
         :rtype: float
+        :raises ValueError: if a scale is unknown
 
         """
-        ureg = UnitRegistry()
-        scaler = [ureg.degF, ureg.degC, ureg.kelvin, ureg.degR]
-        scaler_to = ['degF',  'degC', 'kelvin', 'degR']
-        Q_ = ureg.Quantity
-        cur = self.parse_convert_to_int(curscale, self.cf_tscale)
-        new = self.parse_convert_to_int(newscale, self.cf_tscale)
+        cur = self._temp_scale(curscale)
+        new = self._temp_scale(newscale)
+        return units.scale_temp(temp, cur, new)
 
-        temp_s = Q_(temp, scaler[cur])
-        ntmp = temp_s.to(scaler_to[new])
-        return ntmp.magnitude
+    def gn_scale_temps(self, temps, curscale, newscale):
+        """Rescale many temperatures at once
 
-    def typeofvalue(self, text):
-        try:
-            int(text)
-            return int(text)
-        except ValueError:
-            pass
+        :param temps: sequence or numpy array of temperatures
+        :param curscale: current scale (string or int)
+        :param newscale: new scale (string or int)
+        :returns: temperatures in new scale, a numpy array if numpy is
+            installed, else a list
+        :rtype: numpy.ndarray
+        :raises ValueError: if a scale is unknown
 
-        try:
-            float(text)
-            return float(text)
-        except ValueError:
-            pass
+        """
+        cur = self._temp_scale(curscale)
+        new = self._temp_scale(newscale)
+        return units.scale_temps(temps, cur, new)
 
-        return str(text)
+    def gn_convert(self, values, subtype, curscale, newscale):
+        """Convert device data between two scales
 
-    def word_to_dev(self, device, cmdword):
-        """Convert a gnhast protocol command word to data and store in device
+        Works for every subtype that has a scale: temp, pressure,
+        windspeed, lux, rainrate, distance and salinity.
 
-        :param device: device to store data in
-        :param cmdword: word to parse
-        :returns: nothing
-        :rtype:
+        :param values: a number, or a sequence or numpy array of numbers
+        :param subtype: device subtype (int)
+        :param curscale: current scale (string or int)
+        :param newscale: new scale (string or int)
+        :returns: converted values, same shape as given (a numpy array or
+            list for sequences)
+        :raises ValueError: if the subtype has no scales, or a scale is
+            unknown
 
         """
-        # take a string like devt:1 and import it to a device
-        data = cmdword.split(':')
-        vwords = ['uid', 'name', 'rate', 'rrdname', 'devt', 'proto',
-                  'subt', 'client', 'scale', 'handler', 'hargs', 'tags'
-                  'glist', 'dlist', 'collector', 'alsev', 'altext',
-                  'aluid', 'alchan', 'spamhandler', 'data', 'hiwat', 'lowat']
+        return units.convert(values, subtype, curscale, newscale)
 
-        if data[0] in self.arg_by_subt:
-            data[0] = 'data'
+    def gn_normalize_data(self, dev, value, scale):
+        """Store a reading in a device, in the device's configured scale
 
-        # handle the special case for dimmers
-        if data[0] == 'dimmer':
-            data[0] = 'data'
+        The device's scale comes from its tscale, baroscale, speedscale,
+        lengthscale, lightscale or salinescale entry, whichever matches
+        its subtype.  If it has none, the value is stored as is.
 
-        if data[0] not in vwords:
-            self.LOG_WARNING("Unhandled word: {0}".format(data[0]))
-            return
+        :param dev: device to store the reading in
+        :param value: the reading
+        :param scale: scale the reading is in (string or int)
+        :returns: the value stored in dev['data']
+
+        """
+        family = units.SUBTYPE_FAMILY.get(dev['subtype'])
+        if family is not None and family in dev and dev[family] >= 0:
+            value = units.convert_scale(value, family, scale, dev[family])
+        dev['data'] = value
+        return value
 
-        # Patch the words up a little
-        if data[0] == 'subt':
-            data[0] = 'subtype'
-        if data[0] == 'devt':
-            data[0] = 'type'
+    def typeofvalue(self, text):
+        return protocol.typeofvalue(text)
+
+    def word_to_dev(self, device, cmdword):
+        """Convert a gnhast protocol command word to data and store in device
+
+        :param device: device to store data in
+        :param cmdword: (key, value) pair from protocol.tokenize, or a
+            string like devt:1
+        :returns: the device field the word was stored in, None if the
+            word is unhandled
+        :rtype: str
+
+        """
+        if isinstance(cmdword, str):
+            cmdword = cmdword.split(':', 1)
+        key, value = cmdword
+
+        entry = self.word_map.get(key)
+        if entry is None:
+            self.LOG_WARNING_LIMITED(('word', key), "Unhandled word: {0}", key)
+            return None
+        field, conv = entry
 
         # save our previous value
-        if data[0] == 'data' and 'data' in device.keys():
+        if field == 'data' and 'data' in device:
             device['last'] = device['data']
 
-        device[data[0]] = self.typeofvalue(data[1])
+        device[field] = conv(value)
+        return field
 
     async def command_reg(self, cmd_word):
         """Handle a reg command
 
-        :param cmd_word: list of command word pairs
+        :param cmd_word: tokenized command, see protocol.tokenize
         :returns: nothing
         :rtype:
 
@@ -387,30 +741,31 @@ class gnhast:
         if cmd_word[0] != 'reg':
             return
 
-        dev = copy.deepcopy(self.DEVICE)
+        dev = Device()
         for word in cmd_word[1:]:
             self.word_to_dev(dev, word)
-        self.devices.append(dev)
-        self.LOG_DEBUG("Added device: {0}".format(dev['name']))
+        dev = self.devices.add(dev)
+        self.LOG_DEBUG("Added device: {0}", dev['name'])
+        if self._ldevs_queues:
+            queue = self._ldevs_queues[0].queue
+            if queue is not None:
+                queue.put_nowait(dev)
         await self.int_coll_reg_cb(dev)
 
     def find_dev_byuid(self, uid):
-        """Simple search for a device entry by uid
+        """Look up a device entry by uid
 
         :param uid: uid to search for
         :returns: device dict or None
         :rtype: dict
 
         """
-        for dev in self.devices:
-            if uid == dev['uid']:
-                return dev
-        return None
+        return self.devices.find(uid)
 
     async def command_upd(self, cmd_word):
         """Handle an update command (upd)
 
-        :param cmd_word: list of command word pairs
+        :param cmd_word: tokenized command, see protocol.tokenize
         :returns: nothing
         :rtype:
 
@@ -421,27 +776,40 @@ class gnhast:
         if cmd_word[0] != 'upd':
             return
 
-        dev = None
+        uid = None
+        for key, value in cmd_word[1:]:
+            if key == 'uid':
+                uid = value
+        dev = self.find_dev_byuid(uid)
+
+        new = dev is None
+        if new:
+            # unknown devices are only picked up if someone asked for them
+            if uid not in self._asks:
+                return
+            dev = Device()
+        has_data = False
         for word in cmd_word[1:]:
-            parts = word.split(':')
-            if parts[0] != 'uid':
-                continue
-            dev = self.find_dev_byuid(parts[1])
-
-        if dev is None:
-            return
-
-        for word in cmd_word[1:]:
-            self.word_to_dev(dev, word)
-        cur_time = int(time.time())
-        dev['lastupd'] = cur_time
-        self.LOG_DEBUG("Updated device: {0}".format(dev['name']))
+            if self.word_to_dev(dev, word) == 'data':
+                has_data = True
+        if new:
+            dev = self.devices.add(dev)
+        now = time.time()
+        dev['lastupd'] = int(now)
+        # only fold in a reading if the line carried one
+        if has_data and self.track_stats:
+            self.gn_track_stats(dev, now)
+        if has_data and self.devices.history is not None:
+            self.devices.history.record(dev['uid'], dev['data'], now)
+        self.LOG_DEBUG("Updated device: {0}", dev['name'])
+        if self._asks:
+            self._resolve_asks(dev)
         await self.int_coll_upd_cb(dev)
 
     async def command_chg(self, cmd_word):
         """Handle an change command (chg)
 
-        :param cmd_word: list of command word pairs
+        :param cmd_word: tokenized command, see protocol.tokenize
         :returns: nothing
         :rtype:
 
@@ -453,74 +821,221 @@ class gnhast:
             return
 
         dev = None
-        for word in cmd_word[1:]:
-            parts = word.split(':')
-            if parts[0] != 'uid':
-                continue
-            dev = self.find_dev_byuid(parts[1])
+        for key, value in cmd_word[1:]:
+            if key == 'uid':
+                dev = self.find_dev_byuid(value)
 
         if dev is None:
             return
 
+        has_data = False
         for word in cmd_word[1:]:
-            self.word_to_dev(dev, word)
-        cur_time = int(time.time())
-        dev['lastupd'] = cur_time
-        self.LOG_DEBUG("Changed device: {0}".format(dev['name']))
+            if self.word_to_dev(dev, word) == 'data':
+                has_data = True
+        now = time.time()
+        dev['lastupd'] = int(now)
+        if has_data and self.track_stats:
+            self.gn_track_stats(dev, now)
+        if has_data and self.devices.history is not None:
+            self.devices.history.record(dev['uid'], dev['data'], now)
+        self.LOG_DEBUG("Changed device: {0}", dev['name'])
         await self.int_coll_chg_cb(dev)
 
+    async def command_endldevs(self, cmd_word):
+        """Handle the end of an ldevs listing (endldevs)
+
+        Ends the oldest ldevs request, see gn_list_devices().
+
+        :param cmd_word: tokenized command, see protocol.tokenize
+        """
+        if self._ldevs_queues:
+            queue = self._ldevs_queues.popleft().queue
+            if queue is not None:
+                queue.put_nowait(None)
+        else:
+            self.LOG_DEBUG('Ignored endldevs')
+
+    def _resolve_asks(self, dev):
+        waiters = self._asks.pop(dev['uid'], None)
+        if waiters is None:
+            return
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(dev)
+
+    async def command_ping(self, cmd_word):
+        """Handle a ping from gnhastd
+
+        :param cmd_word: tokenized command, see protocol.tokenize
+        """
+        await self.collector_healthcheck()
+
     def find_alarm_byuid(self, aluid):
-        """Simple search for an alarm entry by uid
+        """Look up an alarm entry by uid
 
         :param aluid: aluid to search for
-        :returns: device dict or None
+        :returns: alarm dict or None
         :rtype: dict
 
         """
-        for alarm in self.alarms:
-            if aluid == alarm['aluid']:
-                return alarm
-        return None
+        return self.alarms.find(aluid)
+
+    def find_alarms(self, alchan=AlarmChan.ALL, minsev=1):
+        """Find all current alarms on a set of channels
+
+        :param alchan: AlarmChan mask to match (default ALL)
+        :param minsev: minimum severity (default 1)
+        :returns: matching alarms, highest severity first
+        :rtype: list
+
+        """
+        return self.alarms.select(alchan, minsev)
 
     async def int_coll_upd_cb(self, dev):
         """Internal device update callback
 
-        Binds to self.coll_upd_cb
+        Binds to self.coll_upd_cb and the 'upd' subscriptions.
+
+        With self.concurrent_callbacks set, the callbacks are queued on
+        self.callback_runner instead of awaited here, so a slow callback
+        does not hold up the listener.  Callbacks for one device still run
+        in order, and each one gets a copy of the device as it was when
+        the update came in, so no reading is lost to a later update.  Use
+        self.devices.find() in the callback to reach the live device.
 
         :param dev: the device that was updated
         """
-
-        if self.coll_upd_cb is None:
-            return
+        if self.concurrent_callbacks:
+            self.callback_runner.submit(dev['uid'], self._device_callbacks,
+                                        'upd', Device(**dev))
         else:
-            await self.coll_upd_cb(dev)
+            await self._device_callbacks('upd', dev)
 
     async def int_coll_chg_cb(self, dev):
         """Internal device change callback
 
-        Binds to self.coll_chg_cb
+        Binds to self.coll_chg_cb and the 'chg' subscriptions, see
+        int_coll_upd_cb().
 
         :param dev: the device that was changed
         """
-
-        if self.coll_chg_cb is None:
-            return
+        if self.concurrent_callbacks:
+            self.callback_runner.submit(dev['uid'], self._device_callbacks,
+                                        'chg', Device(**dev))
         else:
-            await self.coll_chg_cb(self, dev)
-
+            await self._device_callbacks('chg', dev)
 
     async def int_coll_reg_cb(self, dev):
         """Internal device register callback
 
-        Binds to self.coll_reg_cb
+        Binds to self.coll_reg_cb and the 'reg' subscriptions, see
+        int_coll_upd_cb().
 
         :param dev: the device that was registered
         """
-
-        if self.coll_reg_cb is None:
-            return
+        if self.concurrent_callbacks:
+            self.callback_runner.submit(dev['uid'], self._device_callbacks,
+                                        'reg', Device(**dev))
         else:
-            await self.coll_reg_cb(dev)
+            await self._device_callbacks('reg', dev)
+
+    async def _device_callbacks(self, event, dev):
+        if event == 'upd':
+            if self.coll_upd_cb is not None:
+                await self.run_callback(self.coll_upd_cb, dev)
+        elif event == 'chg':
+            if self.coll_chg_cb is not None:
+                await self.run_callback(self.coll_chg_cb, self, dev)
+        elif self.coll_reg_cb is not None:
+            await self.run_callback(self.coll_reg_cb, dev)
+        await self.dispatch_subscriptions(event, dev)
+
+    async def run_callback(self, func, *args):
+        """Call a callback, async or not
+
+        Coroutine functions are awaited.  Plain functions are run in a
+        thread pool if self.callback_threads is set, otherwise called
+        directly; if they return an awaitable it is awaited.
+
+        :param func: the callback
+        :param args: its arguments
+        :returns: whatever the callback returned
+        """
+        if asyncio.iscoroutinefunction(func):
+            return await func(*args)
+        if self.callback_threads:
+            if self._callback_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._callback_pool = ThreadPoolExecutor(
+                    self.callback_threads)
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                self._callback_pool, functools.partial(func, *args))
+        result = func(*args)
+        if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+            result = await result
+        return result
+
+    def _callback_failed(self, func, error):
+        self.LOG_ERROR('Callback {0!r} failed: {1}', func, error)
+
+    def subscribe(self, callback, uid=None, subtype=None, type=None,
+                  tag=None, event='upd'):
+        """Call a function when a matching device is updated
+
+        Any number of subscriptions can be active, each with its own
+        filters.  A filter left at None matches every device.  Unlike
+        coll_chg_cb, the callback is always called as callback(dev), for
+        every event.
+
+        :param callback: function or coroutine function taking the device
+        :param uid: only this device
+        :param subtype: only devices of this subtype, int or cf_subt name
+        :param type: only devices of this type, int or cf_type name
+        :param tag: only devices carrying this tag
+        :param event: 'upd', 'chg' or 'reg'
+        :returns: subscription handle for unsubscribe()
+        :rtype: gnhast.subscriptions.Subscription
+        :raises ValueError: for an unknown event, type or subtype
+
+        """
+        if isinstance(subtype, str):
+            name = subtype
+            subtype = self.parse_convert_to_int(subtype, self.cf_subt)
+            if subtype < 0:
+                raise ValueError('unknown subtype {0!r}'.format(name))
+        if isinstance(type, str):
+            name = type
+            type = self.parse_convert_to_int(type, self.cf_type)
+            if type < 0:
+                raise ValueError('unknown type {0!r}'.format(name))
+        return self.subscriptions.add(event, callback, uid, subtype, type,
+                                      tag)
+
+    def unsubscribe(self, sub):
+        """Remove a subscription made with subscribe()
+
+        :param sub: the subscription handle
+        :returns: True if it was still subscribed
+        :rtype: bool
+
+        """
+        return self.subscriptions.remove(sub)
+
+    async def dispatch_subscriptions(self, event, dev):
+        """Call every subscription matching a device event
+
+        A callback that raises is logged and does not stop the others.
+
+        :param event: 'upd', 'chg' or 'reg'
+        :param dev: the device
+        """
+        for sub in self.subscriptions.match(event, dev):
+            try:
+                await self.run_callback(sub.callback, dev)
+            except Exception as e:
+                self.LOG_ERROR('Callback {0!r} for {1} {2} failed: {3}',
+                               sub.callback, event, dev['uid'], e)
 
     async def int_coll_alarm_cb(self, alarm):
         """Internal callback for alarm
@@ -528,18 +1043,26 @@ class gnhast:
         You can bind a function to self.coll_alarm_cb and it will be called
         on all alarm updates.
 
+        With self.concurrent_callbacks set it is queued on
+        self.callback_runner, in order per aluid, with a copy of the alarm
+        as it was when it came in.
+
         :param alarm: the alarm that we got called for
         """
 
         if self.coll_alarm_cb is None:
             return
+        elif self.concurrent_callbacks:
+            self.callback_runner.submit(('alarm', alarm['aluid']),
+                                        self.run_callback,
+                                        self.coll_alarm_cb, dict(alarm))
         else:
-            await self.coll_alarm_cb(alarm)
+            await self.run_callback(self.coll_alarm_cb, alarm)
 
     async def command_setalarm(self, cmd_word):
         """Handle an alarm set command from the server
 
-        :param cmd_word: list of command word pairs
+        :param cmd_word: tokenized command, see protocol.tokenize
         """
         if not cmd_word[0] or cmd_word[0] == '':
             return
@@ -547,45 +1070,175 @@ class gnhast:
         if cmd_word[0] != 'setalarm':
             return
 
-        alarm = None
+        fields = dict(cmd_word[1:])
 
-        # find the aluid
-        for word in cmd_word[1:]:
-            parts = word.split(':')
-            if parts[0] != 'aluid':
-                continue
-            alarm = self.find_alarm_byuid(parts[1])
+        if 'aluid' not in fields:
+            self.LOG_WARNING('Ignoring setalarm without an aluid')
+            return
+        alarm = self.alarms.find(fields['aluid'])
 
-        # loop again and find the sev
-        for word in cmd_word[1:]:
-            parts = word.split(':')
-            if parts[0] != 'alsev':
-                continue
-            my_sev = int(parts[1])
+        try:
+            for key in ('alsev', 'alchan'):
+                if key in fields:
+                    fields[key] = int(fields[key])
+        except ValueError:
+            self.LOG_WARNING('Bad setalarm for {0}'.format(fields['aluid']))
+            return
 
-        if alarm is None and my_sev > 0:
+        if alarm is None:
+            if fields.get('alsev', 0) == 0:
+                # clearing event for alarm we don't have
+                self.LOG_DEBUG('Clearing event for alarm we do not have')
+                return
             # we got a new alarm
-            alarm = copy.deepcopy(self.ALARM)
-        elif alarm is None and my_sev == 0:
-            # clearing event for alarm we don't have
-            self.LOG_DEBUG('Clearing event for alarm we do not have')
-            return
+            alarm = dict(self.ALARM)
 
         # now update the internal alarm
-        for word in cmd_word[1:]:
-            parts = word.split(':')
-            alarm[parts[0]] = parts[1]
+        alarm.update(fields)
 
         # oops, we got a clearing event, delete the alarm
         if alarm['alsev'] == 0:
-            self.LOG_DEBUG('Deleting alarm {0}'.format(alarm['aluid']))
-            del self.alarms[alarm]
+            self.LOG_DEBUG('Deleting alarm {0}', alarm['aluid'])
+            self.alarms.remove(alarm)
         else:
-            self.alarms.append(alarm)
+            self.alarms.add(alarm)
 
         # Call the internal callback for this alarm
         await self.int_coll_alarm_cb(alarm)
 
+    async def gn_send(self, cmd, caller, uid=None):
+        """Send a command line to gnhastd
+
+        Inside a gn_batch() the line is only buffered, and goes out with
+        the rest of the batch.
+
+        With self.coalesce set, the line is put on self.outq and written by
+        a background task instead, so callers never wait on drain().
+        Updates passed with a uid are coalesced there, see CoalescingQueue.
+
+        :param cmd: the command line, including the newline, str or bytes
+        :param caller: name of the calling method, for error messages
+        :param uid: device uid, if this is an upd line that may be coalesced
+        """
+        if isinstance(cmd, str):
+            cmd = cmd.encode()
+        if self.reconnect and not self.connected:
+            self._queue_pending([cmd])
+            return
+        if self.coalesce:
+            self._outq_put(cmd, uid)
+            return
+        if self._batch_depth > 0:
+            data = cmd
+            self._wbuf.append(data)
+            self._wbuf_size += len(data)
+            if self._wbuf_size >= self.batch_maxbytes:
+                await self.gn_flush()
+            elif self._wbuf_timer is None:
+                loop = self.loop or asyncio.get_event_loop()
+                self._wbuf_timer = loop.call_later(
+                    self.batch_maxdelay,
+                    lambda: asyncio.ensure_future(self.gn_flush()))
+            return
+
+        try:
+            self.writer.write(cmd)
+            await self.writer.drain()
+        except Exception as e:
+            self.LOG_ERROR('Write to gnhast failed in {0}: {1}'.format(caller, str(e)))
+            if self.reconnect:
+                self._queue_pending([cmd])
+            await self.gn_connfail()
+
+    def _outq_put(self, line, uid=None):
+        self.outq.put(line, uid)
+        if self._outq_task is None:
+            self._outq_event = asyncio.Event()
+            self._outq_task = asyncio.ensure_future(self._outq_writer())
+        self._outq_event.set()
+
+    async def _outq_writer(self):
+        """Background task writing out self.outq"""
+        while True:
+            await self._outq_event.wait()
+            self._outq_event.clear()
+            await self._outq_flush()
+
+    async def _outq_flush(self):
+        lines = self.outq.take()
+        if not lines:
+            return
+        if self.reconnect and not self.connected:
+            self._queue_pending(lines)
+            return
+        try:
+            self.writer.writelines(lines)
+            await self.writer.drain()
+        except Exception as e:
+            self.LOG_ERROR('Write to gnhast failed in gn_send: {0}'.format(str(e)))
+            if self.reconnect:
+                self._queue_pending(lines)
+            await self.gn_connfail()
+
+    def _queue_pending(self, lines):
+        """Hold lines sent while disconnected, dropping the oldest if full"""
+        for line in lines:
+            if len(self._pending) >= self.pending_max:
+                self._pending.popleft()
+                self.pending_dropped += 1
+            self._pending.append(line)
+
+    async def gn_flush(self):
+        """Write out everything buffered by gn_batch() with a single drain
+
+        Also writes out anything waiting in the coalescing queue.
+        """
+        await self._outq_flush()
+        if self._wbuf_timer is not None:
+            self._wbuf_timer.cancel()
+            self._wbuf_timer = None
+        if not self._wbuf:
+            return
+        data = self._wbuf
+        self._wbuf = []
+        self._wbuf_size = 0
+        if self.reconnect and not self.connected:
+            self._queue_pending(data)
+            return
+        try:
+            self.writer.writelines(data)
+            await self.writer.drain()
+        except Exception as e:
+            self.LOG_ERROR('Write to gnhast failed in gn_flush: {0}'.format(str(e)))
+            if self.reconnect:
+                self._queue_pending(data)
+            await self.gn_connfail()
+
+    def gn_cork(self):
+        """Start buffering outgoing commands, see gn_batch()
+        """
+        self._batch_depth += 1
+
+    async def gn_uncork(self):
+        """Stop buffering outgoing commands and flush them
+        """
+        if self._batch_depth > 0:
+            self._batch_depth -= 1
+        if self._batch_depth == 0:
+            await self.gn_flush()
+
+    def gn_batch(self):
+        """Batch outgoing commands into one write
+
+        Use as ``async with gn.gn_batch():``.  Every gn_* send inside the
+        block is buffered and written with a single drain when the block
+        exits, or earlier once batch_maxbytes are buffered or the oldest
+        buffered line is batch_maxdelay seconds old.  Batches may nest.
+
+        :returns: async context manager
+        """
+        return _Batch(self)
+
     async def gn_register_device(self, dev):
         """Register a new device with gnhast
 
@@ -609,44 +1262,214 @@ class gnhast:
             cmd += 'scale:{0} '.format(dev['scale'])
         cmd += 'devt:{0} subt:{1} proto:{2}\n'.format(dev['type'], dev['subtype'], str(dev['proto']))
 
-        try:
-            self.writer.write(cmd.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_update_device: {0}'.format(str(e)))
-            await self.gn_connfail()
+        self._replay[('reg', dev['uid'])] = cmd.encode()
+        await self.gn_send(cmd, 'gn_register_device')
 
-    async def gn_update_device(self, dev, full=False):
-        """Update the data for a device with gnhast
+    def upd_prefix(self, dev, full=False):
+        """Build the constant part of an upd line for a device
 
         :param dev: device to update
-        :returns:
-        :rtype:
+        :param full: include name, rrdname and scale
+        :returns: the line up to and including ``<dataword>:``, or None if
+            the device is not fit to send
+        :rtype: str
 
         """
         if dev['name'] == '' or dev['uid'] == '':
-            return
+            return None
         if dev['type'] == 0 or dev['subtype'] == 0:
-            return
+            return None
 
         if full:
             cmd = 'upd uid:{0} name:"{1}" '.format(dev['uid'], dev['name'])
-            if dev['rrdname'] != '':
+            # devices from the config file only carry the keys set there
+            if dev.get('rrdname', '') != '':
                 cmd += 'rrdname:"{0}" '.format(dev['rrdname'])
-            if dev['scale'] != 0:
+            if dev.get('scale', 0) != 0:
                 cmd += 'scale:{0} '.format(dev['scale'])
                 cmd += 'devt:{0} subt:{1} proto:1 '.format(dev['type'], dev['subtype'])
         else:
             cmd = 'upd uid:{0} '.format(dev['uid'])
 
-        cmd += '{0}:{1}\n'.format(self.arg_by_subt[dev['subtype']], dev['data'])
+        return cmd + '{0}:'.format(self.arg_by_subt[dev['subtype']])
 
-        try:
-            self.writer.write(cmd.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_update_device: {0}'.format(str(e)))
-            await self.gn_connfail()
+    def gn_suppress_update(self, dev):
+        """Decide if an update for a device can be skipped
+
+        Only devices that ask for it are suppressed:
+
+        * spamhandler = onchange drops values equal to the last one sent
+        * deadband = N drops values within N of the last one sent
+        * deadband_pct = N drops values within N percent of the last one
+          sent
+
+        and with maxsilence = N set, an update is forced through at least
+        every N seconds anyway.  Skipped updates are counted per uid in
+        self.suppressed.
+
+        :param dev: device about to be updated
+        :returns: True if the update should not be sent
+        :rtype: bool
+
+        """
+        onchange = dev.get('spamhandler', 0) == 2
+        band = dev.get('deadband', 0)
+        pct = dev.get('deadband_pct', 0)
+        if not onchange and not band and not pct:
+            return False
+
+        uid = dev['uid']
+        data = dev['data']
+        now = time.monotonic()
+        state = self._sendstate.get(uid)
+        if state is not None:
+            last, when = state
+            silence = dev.get('maxsilence', 0)
+            if not silence or now - when < silence:
+                skip = data == last
+                if not skip and (band or pct):
+                    try:
+                        diff = abs(data - last)
+                        skip = diff <= band or diff * 100 <= abs(last) * pct
+                    except TypeError:
+                        pass
+                if skip:
+                    self.suppressed[uid] = self.suppressed.get(uid, 0) + 1
+                    return True
+
+        self._sendstate[uid] = (data, now)
+        return False
+
+    async def gn_update_device(self, dev, full=False):
+        """Update the data for a device with gnhast
+
+        Updates may be skipped by gn_suppress_update().
+
+        :param dev: device to update
+        :returns:
+        :rtype:
+
+        """
+        if self.track_stats:
+            self.gn_track_stats(dev)
+        if self.devices.history is not None:
+            self.devices.history.record(dev['uid'], dev['data'], time.time())
+        cmd = self.upd_prefix(dev, full)
+        if cmd is None or self.gn_suppress_update(dev):
+            return
+        cmd += '{0}\n'.format(dev['data'])
+
+        await self.gn_send(cmd, 'gn_update_device', uid=dev['uid'])
+
+    def gn_track_stats(self, dev, when=None):
+        """Fold the current data of a device into its statistics
+
+        Sets the device's min and max, avg (the windowed mean if
+        self.stats has a window, else the EWMA) and change (rate of change
+        per second).  With self.track_stats set this is done for every
+        upd and chg received and every update sent.  Replace self.stats
+        with StatsTable(window=..., tau=...) to change the window or the
+        EWMA time constant.  Non numeric data is ignored.
+
+        :param dev: the device
+        :param when: time of the data, default now
+        :returns: the device statistics, or None for non numeric data
+        :rtype: gnhast.stats.RunningStats
+
+        """
+        value = dev['data']
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        if when is None:
+            when = time.time()
+        st = self.stats.update(dev['uid'], value, when)
+        dev['min'] = st.min
+        dev['max'] = st.max
+        dev['avg'] = st.mean
+        dev['change'] = st.rate
+        return st
+
+    def gn_columnar_devices(self, capacity=1024):
+        """Switch self.devices to a columnar table
+
+        For collectors mirroring tens of thousands of devices.  Devices
+        already registered are copied over.  From then on devices are
+        ColumnarRegistry rows: use what new_device(), find_dev_byuid()
+        and self.devices.add() return rather than the object passed in,
+        and see ColumnarRegistry.select() and stale() for bulk queries.
+
+        :param capacity: rows to allocate up front
+        :returns: the new device table
+        :rtype: gnhast.columnar.ColumnarRegistry
+
+        """
+        from gnhast.columnar import ColumnarRegistry
+
+        table = ColumnarRegistry(self.devices, capacity)
+        table.history = self.devices.history
+        self.devices = table
+        return table
+
+    def gn_enable_history(self, size=1440):
+        """Keep the last readings of every device
+
+        Attaches a HistoryStore to self.devices.  From then on every
+        numeric reading received in an upd or chg, or sent with
+        gn_update_device(s), is recorded.  Query it with
+        gn.devices.history.get(uid).mean(since) and friends.
+
+        :param size: readings kept per device, memory is 16 bytes per
+            reading per device
+        :returns: the history store
+        :rtype: gnhast.history.HistoryStore
+
+        """
+        if self.devices.history is None or self.devices.history.size != size:
+            self.devices.history = HistoryStore(size)
+        return self.devices.history
+
+    async def gn_update_devices(self, devs, full=False):
+        """Update the data for many devices with gnhast in one write
+
+        The encoded upd prefix of each device is cached, and rebuilt only
+        when its uid, name, rrdname, type, subtype or scale change, so a
+        poller that sends the same devices every cycle only formats the
+        data values.  Updates may be skipped by gn_suppress_update().
+
+        :param devs: iterable of devices to update
+        :param full: send full updates, as gn_update_device
+        :returns:
+        :rtype:
+
+        """
+        cache = self._upd_cache
+        lines = []
+        now = time.time()
+        history = self.devices.history
+        for dev in devs:
+            if self.track_stats:
+                self.gn_track_stats(dev, now)
+            if history is not None:
+                history.record(dev['uid'], dev['data'], now)
+            key = (dev['uid'], dev['name'], dev.get('rrdname', ''),
+                   dev['type'], dev['subtype'], dev.get('scale', 0), full)
+            hit = cache.get(key[0])
+            if hit is None or hit[0] != key:
+                prefix = self.upd_prefix(dev, full)
+                if prefix is not None:
+                    prefix = prefix.encode()
+                hit = (key, prefix)
+                cache[key[0]] = hit
+            if hit[1] is None or self.gn_suppress_update(dev):
+                continue
+            line = hit[1] + str(dev['data']).encode() + b'\n'
+            if self.coalesce and (self.connected or not self.reconnect):
+                self._outq_put(line, dev['uid'])
+            else:
+                lines.append(line)
+
+        if lines:
+            await self.gn_send(b''.join(lines), 'gn_update_devices')
 
     async def gn_change_device(self, dev, newdata):
         """Ask gnhastd to change data about a device
@@ -672,38 +1495,56 @@ class gnhast:
         cmd = 'chg uid:{0}" '.format(dev['uid'])
         cmd += '{0}:{1}\n'.format(self.arg_by_subt[dev['subtype']], dev['data'])
 
-        try:
-            self.writer.write(cmd.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_change_device: {0}'.format(str(e)))
-            await self.gn_connfail()
+        await self.gn_send(cmd, 'gn_change_device')
+
+    @staticmethod
+    def _ldevs_line(uid, type, subtype):
+        cmd = 'ldevs '
+        if type > 0:
+            cmd += 'devt:{0} '.format(type)
+        if subtype > 0:
+            cmd += 'subt:{0} '.format(subtype)
+        if uid != '':
+            cmd += 'uid:"{0}" '.format(uid)
+        return cmd + '\n'
 
     async def gn_ldevs(self, uid='', type=0, subtype=0):
         """Send an ldevs command to gnhastd, asking for a list of devices
 
+        The devices come in through command_reg(), use gn_list_devices()
+        to get them back directly.
+
         :param uid: optional uid qualifier
         :param type: optional type qualifier
         :param subtype: optional subtype qualifier
-        :returns: nothing
+        :returns: None
         :rtype: None
 
         """
-        cmd = 'ldevs '
-        if type > 0:
-            cmd += 'devt:{0} '.format(type)
-        if subtype > 0:
-            cmd += 'subt:{0} '.format(subtype)
-        if uid != '':
-            cmd += 'uid:"{0}" '.format(uid)
-        cmd += '\n'
+        await _Ldevs(self, self._ldevs_line(uid, type, subtype),
+                     None)._send(None)
 
-        try:
-            self.writer.write(cmd.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_ldevs: {0}'.format(str(e)))
-            await self.gn_connfail()
+    def gn_list_devices(self, uid='', type=0, subtype=0, timeout=None):
+        """List devices known to gnhastd
+
+        ``async for dev in gn.gn_list_devices()`` sends an ldevs request
+        and yields every device as gnhastd lists it, stopping at the
+        endldevs that ends the listing.  The devices also go through
+        command_reg() as usual.  Listings are answered in order, so
+        several can be iterated at once.  A listing that times out, or is
+        left with aclose(), drops the rest of its devices.
+
+        :param uid: optional uid qualifier
+        :param type: optional type qualifier
+        :param subtype: optional subtype qualifier
+        :param timeout: seconds to wait for each device before raising
+            asyncio.TimeoutError, None waits forever
+        :returns: async iterable listing
+        :raises ConnectionError: while iterating, if the connection to
+            gnhastd is lost during the listing
+
+        """
+        return _Ldevs(self, self._ldevs_line(uid, type, subtype), timeout)
 
     async def gn_feed_device(self, dev, rate):
         """Ask gnhastd for a continous feed of updates for a device
@@ -721,12 +1562,8 @@ class gnhast:
 
         cmd = 'feed uid:{0} rate:{1}\n'.format(dev['uid'], rate)
 
-        try:
-            self.writer.write(cmd.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_feed_device: {0}'.format(str(e)))
-            await self.gn_connfail()
+        self._replay[('feed', dev['uid'])] = cmd.encode()
+        await self.gn_send(cmd, 'gn_feed_device')
 
     async def gn_cfeed_device(self, dev):
         """Ask gnhastd for a feed of updates for a device as the device changes
@@ -743,12 +1580,8 @@ class gnhast:
 
         cmd = 'cfeed uid:{0}\n'.format(dev['uid'])
 
-        try:
-            self.writer.write(cmd.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_cfeed_device: {0}'.format(str(e)))
-            await self.gn_connfail()
+        self._replay[('cfeed', dev['uid'])] = cmd.encode()
+        await self.gn_send(cmd, 'gn_cfeed_device')
 
     async def gn_setalarm(self, aluid, altext, alsev, alchan):
         """Set or modify an alarm in gnhast
@@ -768,12 +1601,7 @@ class gnhast:
             cmd = 'setalarm aluid:{0} altext:"{1}" alsev:{2} alchan:{3}\n' \
                   .format(aluid, altext, alsev, int(alchan))
 
-        try:
-            self.writer.write(cmd.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_setalarm: {0}'.format(str(e)))
-            await self.gn_connfail()
+        await self.gn_send(cmd, 'gn_setalarm')
 
 
     async def gn_listenalarms(self, alsev, alchan):
@@ -784,12 +1612,8 @@ class gnhast:
         """
         cmd = 'listenalarms alchan:{0} alsev:{1}\n' \
               .format(int(alchan), alsev)
-        try:
-            self.writer.write(cmd.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_listenalarms: {0}'.format(str(e)))
-            await self.gn_connfail()
+        self._replay[('listenalarms', int(alchan), alsev)] = cmd.encode()
+        await self.gn_send(cmd, 'gn_listenalarms')
 
 
     async def gn_dumpalarms(self, alsev=1, alchan=AlarmChan.ALL, aluid=None):
@@ -808,12 +1632,7 @@ class gnhast:
         if aluid is not None:
             cmd += 'aluid:{0} '.format(aluid)
         cmd += '\n'
-        try:
-            self.writer.write(cmd.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_dumpalarms: {0}'.format(str(e)))
-            await self.gn_connfail()
+        await self.gn_send(cmd, 'gn_dumpalarms')
 
 
     async def gn_rawcmd(self, cmd):
@@ -823,12 +1642,7 @@ class gnhast:
         """
 
         csend = cmd + '\n'
-        try:
-            self.writer.write(csend.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_rawcmd: {0}'.format(str(e)))
-            await self.gn_connfail()
+        await self.gn_send(csend, 'gn_rawcmd')
 
 
     async def gn_ask_device(self, dev, full=False):
@@ -849,25 +1663,104 @@ class gnhast:
         else:
             cmd = 'ask uid:{0}\n'.format(dev['uid'])
 
+        await self.gn_send(cmd, 'gn_ask_device')
+
+
+    async def gn_ask(self, uid, timeout=None, full=False):
+        """Ask gnhastd for current data for a device, and wait for it
+
+        Resolved by the next upd for the uid.  A device we did not know
+        about yet is added to self.devices.
+
+        :param uid: uid of the device, or the device itself
+        :param timeout: seconds to wait, None waits forever
+        :param full: send askf instead of ask
+        :returns: the updated device
+        :rtype: dict
+        :raises asyncio.TimeoutError: if no reply came within timeout
+        :raises ConnectionError: if the connection to gnhastd was lost
+            before the reply came
+
+        """
+        if not isinstance(uid, str):
+            uid = uid['uid']
+        fut = self._ask_future(uid)
         try:
-            self.writer.write(cmd.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_ask_device: {0}'.format(str(e)))
-            await self.gn_connfail()
+            await self.gn_send(self._ask_line(uid, full), 'gn_ask')
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self._ask_done(uid, fut)
+
+    async def gn_ask_devices(self, devs, full=False, timeout=None):
+        """Ask gnhastd about many devices at once, and wait for the replies
+
+        All the ask lines go out in a single write, so asking about N
+        devices costs one round trip rather than N.
 
+        :param devs: devices or uids to ask about
+        :param full: send askf instead of ask
+        :param timeout: seconds to wait for all replies, None waits forever
+        :returns: (dict of uid -> updated device, in the order asked,
+            list of uids that got no reply within timeout, or before the
+            connection to gnhastd was lost)
+        :rtype: tuple
+
+        """
+        uids = []
+        seen = set()
+        for dev in devs:
+            uid = dev if isinstance(dev, str) else dev['uid']
+            if uid not in seen:
+                seen.add(uid)
+                uids.append(uid)
+        if not uids:
+            return dict(), []
+
+        futs = [self._ask_future(uid) for uid in uids]
+        try:
+            cmd = ''.join(self._ask_line(uid, full) for uid in uids)
+            await self.gn_send(cmd, 'gn_ask_devices')
+            await asyncio.wait(futs, timeout=timeout)
+        finally:
+            for uid, fut in zip(uids, futs):
+                self._ask_done(uid, fut)
+
+        found = dict()
+        missing = []
+        for uid, fut in zip(uids, futs):
+            if fut.done() and not fut.cancelled() and \
+                    fut.exception() is None:
+                found[uid] = fut.result()
+            else:
+                missing.append(uid)
+        return found, missing
+
+    @staticmethod
+    def _ask_line(uid, full):
+        if full:
+            return 'askf uid:{0}\n'.format(uid)
+        return 'ask uid:{0}\n'.format(uid)
+
+    def _ask_future(self, uid):
+        fut = asyncio.get_event_loop().create_future()
+        self._asks.setdefault(uid, []).append(fut)
+        return fut
+
+    def _ask_done(self, uid, fut):
+        if not fut.done():
+            fut.cancel()
+        waiters = self._asks.get(uid)
+        if waiters is not None and fut in waiters:
+            waiters.remove(fut)
+            if not waiters:
+                del self._asks[uid]
 
     async def gn_imalive(self):
         """Send a ping reply
         """
         self.LOG_DEBUG("PING REPLY")
         cmd = "imalive\n"
-        try:
-            self.writer.write(cmd.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_imalive: {0}'.format(str(e)))
-            await self.gn_connfail()
+        await self.gn_send(cmd, 'gn_imalive')
 
 
     async def collector_healthcheck(self):
@@ -886,7 +1779,10 @@ class gnhast:
         :rtype:
 
         """
+        self._closing = True
+        await self.gn_flush_conf()
         if self.writer is not None:
+            await self.gn_flush()
             try:
                 self.writer.write("disconnect\n".encode())
                 await self.writer.drain()
@@ -907,12 +1803,8 @@ class gnhast:
             send = "client client:{0}-{1:03d}\n".format(name, self.instance)
         else:
             send = "client client:{0}\n".format(name)
-        try:
-            self.writer.write(send.encode())
-            await self.writer.drain()
-        except Exception as e:
-            self.LOG_ERROR('Write to gnhast failed in gn_client_name: {0}'.format(str(e)))
-            await self.gn_connfail()
+        self._replay[('client',)] = send.encode()
+        await self.gn_send(send, 'gn_client_name')
 
     async def shutdown(self, sig, loop):
         """Shutdown the collector
@@ -923,13 +1815,14 @@ class gnhast:
         :rtype:
 
         """
-        self.LOG_DEBUG('caught {0}'.format(sig.name))
+        self.LOG_DEBUG('caught {0}', sig.name)
+        self.log_limited_summary()
         await self.gn_disconnect()
         tasks = [task for task in asyncio.Task.all_tasks() if task is not
                  asyncio.tasks.Task.current_task()]
         list(map(lambda task: task.cancel(), tasks))
         results = await asyncio.gather(*tasks, return_exceptions=True)
-        self.LOG_DEBUG('finished awaiting cancelled tasks, results: {0}'.format(results))
+        self.LOG_DEBUG('finished awaiting cancelled tasks, results: {0}', results)
         loop.stop()
 
     async def abort(self):
@@ -945,14 +1838,113 @@ class gnhast:
 
     async def gn_connfail(self):
         """A connection to gnhastd failed somehow
-        For now, just abort hard and let systemd fix it.
-        Maybe later, we hack it up to be more intelligent
+
+        Unless self.reconnect is set, just abort hard and let systemd fix
+        it.  In reconnect mode, start gn_reconnect() in the background;
+        until it succeeds, sends are held in a queue of at most
+        self.pending_max lines.
 
         :returns: None
         :rtype: None
         """
         self.LOG_ERROR("Connection failure to gnhastd")
-        await self.abort()
+        if not self.reconnect or self._closing:
+            await self.abort()
+            return
+        self.connected = False
+        # listings in flight will never see their endldevs
+        while self._ldevs_queues:
+            queue = self._ldevs_queues.popleft().queue
+            if queue is not None:
+                queue.put_nowait(
+                    ConnectionError('connection to gnhastd lost'))
+        # and neither will asks, their lines went down with the connection
+        asks = self._asks
+        self._asks = dict()
+        for waiters in asks.values():
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_exception(
+                        ConnectionError('connection to gnhastd lost'))
+        if self._reconnect_task is None:
+            self._reconnect_task = asyncio.ensure_future(self.gn_reconnect())
+
+    async def gn_reconnect(self):
+        """Reconnect to gnhastd and restore our session
+
+        Retries with exponential backoff and jitter, between
+        self.reconnect_min and self.reconnect_max seconds.  The backoff
+        only starts over once a connection has stayed up for
+        self.reconnect_stable seconds, so a server that accepts and then
+        drops us is not hammered.  Once connected,
+        re-sends our client name, every device registration, feed, cfeed
+        and listenalarms we have sent, then whatever was queued while we
+        were disconnected.
+
+        :returns: None
+        :rtype: None
+        """
+        host, port = self.gnhastd_addr
+        delay = self._reconnect_delay or self.reconnect_min
+        try:
+            if self._connected_at is not None:
+                if time.monotonic() - self._connected_at >= self.reconnect_stable:
+                    delay = self.reconnect_min
+                else:
+                    # the last connection did not last, back off first
+                    wait = random.uniform(delay / 2, delay)
+                    self.LOG_WARNING('Connection to gnhastd dropped quickly, reconnect in {0:.2f}s'.format(wait))
+                    await asyncio.sleep(wait)
+                    delay = min(delay * 2, self.reconnect_max)
+            while True:
+                try:
+                    if self.writer is not None:
+                        self.writer.close()
+                except Exception:
+                    pass
+                try:
+                    await self._gn_open(host, port)
+                    replay = list(self._replay.values())
+                    client = self._replay.get(('client',))
+                    if client is not None:
+                        replay.remove(client)
+                        replay.insert(0, client)
+                    self.writer.writelines(replay)
+                    await self.writer.drain()
+                    # send what was queued while we were down, more may be
+                    # queued while we wait on the drain
+                    replayed = set(replay)
+                    while self._pending:
+                        lines = [line for line in self._pending
+                                 if line not in replayed]
+                        self._pending.clear()
+                        self.writer.writelines(lines)
+                        await self.writer.drain()
+                except (asyncio.TimeoutError, OSError) as e:
+                    wait = random.uniform(delay / 2, delay)
+                    self.LOG_WARNING('Reconnect to gnhastd failed: {0}, retry in {1:.2f}s'.format(str(e), wait))
+                    await asyncio.sleep(wait)
+                    delay = min(delay * 2, self.reconnect_max)
+                    continue
+                self.connected = True
+                self._connected_at = time.monotonic()
+                self._reconnect_delay = delay
+                self.LOG('Reconnected to gnhastd {0}:{1}'.format(host, str(port)))
+                return
+        finally:
+            self._reconnect_task = None
+
+    async def gn_wait_connected(self):
+        """Wait for a reconnect in progress to finish
+        """
+        while self._reconnect_task is not None:
+            await asyncio.shield(self._reconnect_task)
+
+    async def _gn_open(self, host, port):
+        # without a timeout a black-holed host blocks for the kernel's
+        # SYN timeout, minutes
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), self.connect_timeout)
 
     async def gn_connect(self, host='127.0.0.1', port=2920):
         """Create a new connection to gnhastd server
@@ -963,12 +1955,15 @@ class gnhast:
         :rtype:
 
         """
+        self.gnhastd_addr = (host, port)
         try:
-            self.reader, self.writer = await asyncio.open_connection(host, port, loop=self.loop)
+            await self._gn_open(host, port)
+            self.connected = True
+            self._connected_at = time.monotonic()
             return self
-        except (asyncio.TimeoutError, ConnectionRefusedError):
-            self.LOG_ERROR("Cannot connect to gnhastd {0}:{1}".format(host, str(port)))
-            raise ConnectionError('Connection to gnhastd Failed')
+        except (asyncio.TimeoutError, OSError) as e:
+            self.LOG_ERROR("Cannot connect to gnhastd {0}:{1}: {2}".format(host, str(port), str(e)))
+            raise ConnectionError('Connection to gnhastd Failed') from e
 
     async def gnhastd_listener(self):
         """Listen to gnhastd for commands and info
@@ -983,32 +1978,37 @@ class gnhast:
                 data = await self.reader.readline()
             except Exception as e:
                 self.LOG_ERROR('Read from gnhastd failed: {0}'.format(str(e)))
-                # fail hard here, let the service system fix it with a restart
-                await self.abort()
-            if data.decode() == '':
+                if not self.reconnect:
+                    # fail hard here, let the service system fix it with a restart
+                    await self.abort()
+                data = b''
+            if data == b'':
+                if self.reconnect and not self._closing:
+                    if self.connected:
+                        await self.gn_connfail()
+                    await self.gn_wait_connected()
+                    continue
                 valid_data = False
-            command = data.decode()
-            if command != '':
-                self.LOG_DEBUG('Got command: {0}'.format(command.rstrip()))
-                cmd_words = shlex.split(command.rstrip())
-                # pprint(cmd_words)
+                continue
+            try:
+                cmd_words = protocol.tokenize(data)
+            except ValueError:
+                self.LOG_WARNING_LIMITED('garbage', "Ignoring garbage command")
+                continue
+            if cmd_words:
+                if self.debug:
+                    self.LOG_DEBUG('Got command: {0}', data.decode().rstrip())
                 if not cmd_words[0] or cmd_words[0] == '':
-                    self.LOG_WARNING("Ignoring garbage command")
+                    self.LOG_WARNING_LIMITED('garbage',
+                                             "Ignoring garbage command")
                     continue
-                if cmd_words[0] == 'reg':
-                    await self.command_reg(cmd_words)
-                elif cmd_words[0] == 'upd':
-                    await self.command_upd(cmd_words)
-                elif cmd_words[0] == 'chg':
-                    await self.command_chg(cmd_words)
-                elif cmd_words[0] == 'endldevs':
-                    self.LOG_DEBUG('Ignored endldevs')
-                elif cmd_words[0] == 'ping':
-                    await self.collector_healthcheck()
-                elif cmd_words[0] == 'setalarm':
-                    await self.command_setalarm(cmd_words)
+                handler = self.cmd_handlers.get(cmd_words[0])
+                if handler is None:
+                    self.LOG_WARNING_LIMITED(('command', cmd_words[0]),
+                                             'Unhandled command: {0}',
+                                             cmd_words[0])
                 else:
-                    self.LOG_WARNING('Unhandled command')
+                    await handler(cmd_words)
 
     async def gn_build_client(self, client_name):
         """Build a new client for gnhastd
@@ -1024,10 +2024,12 @@ class gnhast:
         # open a connection to gnhastd
         try:
             await self.gn_connect(self.config['gnhastd']['hostname'], self.config['gnhastd']['port'])
-            # send our name
-            await self.gn_client_name(client_name)
         except ConnectionError:
-            await self.abort()
+            if not self.reconnect:
+                await self.abort()
+            await self.gn_connfail()
+        # send our name, in reconnect mode this is queued until we connect
+        await self.gn_client_name(client_name)
 
     def log_open(self):
         """Open the logfile for writing
@@ -1036,6 +2038,7 @@ class gnhast:
         :rtype: file descriptor
 
         """
+        self._logwriter.flush()
         try:
             if self.log != sys.stderr:
                 self.log.close()
@@ -1053,23 +2056,86 @@ class gnhast:
         except KeyError:
             self.log = sys.stderr
 
-    def LOG(self, msg, mode=LOG_INFO):
-        if mode == LOG_INFO:
-            ls = '{0} [INFO]:'.format(datetime.now().ctime())
-        elif mode == LOG_ERROR:
-            ls = '{0} [ERROR]:'.format(datetime.now().ctime())
-        elif mode == LOG_WARNING:
-            ls = '{0} [WARNING]:'.format(datetime.now().ctime())
-        elif mode == LOG_DEBUG:
-            ls = '{0} [DEBUG]:'.format(datetime.now().ctime())
-        print(ls + msg, file=self.log)
-
-    def LOG_DEBUG(self, msg):
+    def LOG(self, msg, mode=LOG_INFO, *args):
+        """Log a message
+
+        With args, msg is a str.format() template, filled in right away
+        so the line shows the values as they are now.  Unless
+        self.log_async is False, lines are written by a background thread,
+        so this never blocks.
+
+        :param msg: message, or template if there are args
+        :param mode: one of the LOG_* levels
+        :param args: arguments for the template
+        """
+        level = LOG_LEVELS.get(mode, 'INFO')
+        if self.log_async:
+            self._logwriter.write(self.log, time.time(), level, msg, args)
+        else:
+            self._logwriter.flush()
+            self.log.write(self._logwriter.format(time.time(), level, msg,
+                                                  args))
+
+    def LOG_DEBUG(self, msg, *args):
         if self.debug:
-            self.LOG(msg, mode=LOG_DEBUG)
+            self.LOG(msg, LOG_DEBUG, *args)
+
+    def LOG_ERROR(self, msg, *args):
+        self.LOG(msg, LOG_ERROR, *args)
+
+    def LOG_WARNING(self, msg, *args):
+        self.LOG(msg, LOG_WARNING, *args)
+
+    def LOG_WARNING_LIMITED(self, key, msg, *args):
+        """Log a warning, rate limited per key
 
-    def LOG_ERROR(self, msg):
-        self.LOG(msg, mode=LOG_ERROR)
+        The first warning for a key is logged.  After that at most one
+        summary line every log_limit_interval seconds says how many more
+        times it was seen.  Every occurrence is counted, see log_count().
+
+        :param key: hashable key the warnings are deduplicated by
+        :param msg: message, or template if there are args
+        :param args: arguments for the template
+        """
+        now = time.monotonic()
+        state = self.log_counts.get(key)
+        if state is None:
+            # count, count when last logged, time last logged, msg, args
+            self.log_counts[key] = [1, 1, now, msg, args]
+            self.LOG(msg, LOG_WARNING, *args)
+            return
+        state[0] += 1
+        state[3] = msg
+        state[4] = args
+        if now - state[2] >= self.log_limit_interval:
+            self._log_limited(state, now)
+
+    def _log_limited(self, state, now):
+        count, reported, last, msg, args = state
+        msg = self._logwriter.render(msg, args)
+        self.LOG('{0} (seen {1} more times in {2:.0f}s)', LOG_WARNING, msg,
+                 count - reported, now - last)
+        state[1] = count
+        state[2] = now
+
+    def log_limited_summary(self):
+        """Log the summary line for every rate limited warning that has
+        occurrences not logged yet"""
+        now = time.monotonic()
+        for state in self.log_counts.values():
+            if state[0] != state[1]:
+                self._log_limited(state, now)
+
+    def log_count(self, key):
+        """How often a rate limited warning was seen
+
+        :param key: key passed to LOG_WARNING_LIMITED()
+        :returns: number of occurrences
+        :rtype: int
+        """
+        state = self.log_counts.get(key)
+        return 0 if state is None else state[0]
 
-    def LOG_WARNING(self, msg):
-        self.LOG(msg, mode=LOG_WARNING)
+    def log_flush(self):
+        """Wait until every queued log line has been written"""
+        self._logwriter.flush()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+.. module:: history
+Fixed size history of device readings
+
+Each device gets a ring buffer of timestamps and values, as numpy arrays
+if numpy is installed and as array('d') otherwise, so a device costs
+16 bytes per sample no matter how long it runs.  Window queries work on
+views of the buffer (numpy slices, or memoryviews of the arrays) instead
+of copying it.
+"""
+
+from array import array
+
+from gnhast import units
+
+
+def _percentile(values, q):
+    # linear interpolation between closest ranks, as numpy.percentile
+    values = sorted(values)
+    if not values:
+        return None
+    pos = (len(values) - 1) * q / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+class History:
+    """Ring buffer of the last ``size`` readings of one device.
+
+    Readings are expected in time order.  Every query takes an optional
+    ``since`` time, and then only looks at readings taken at or after it.
+    """
+
+    __slots__ = ('size', 'count', 'times', 'values', '_pos', '_numpy')
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('history size must be at least 1')
+        self.size = size
+        self.count = 0
+        self._pos = 0
+        self._numpy = units.get_numpy()
+        if self._numpy is not None:
+            self.times = self._numpy.zeros(size)
+            self.values = self._numpy.zeros(size)
+        else:
+            self.times = array('d', bytes(8 * size))
+            self.values = array('d', bytes(8 * size))
+
+    def append(self, when, value):
+        """Add a reading, overwriting the oldest once the buffer is full
+
+        :param when: time of the reading, seconds
+        :param value: the reading
+        """
+        pos = self._pos
+        self.times[pos] = when
+        self.values[pos] = value
+        pos += 1
+        if pos == self.size:
+            pos = 0
+        self._pos = pos
+        if self.count < self.size:
+            self.count += 1
+
+    def _start(self, since):
+        # chronological offset of the first reading at or after since
+        first = self._pos - self.count
+        times = self.times
+        size = self.size
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[(first + mid) % size] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def segments(self, since=None):
+        """The readings as at most two runs of views, oldest first
+
+        :param since: only readings at or after this time
+        :returns: list of (times, values) views into the buffer, numpy
+            arrays or memoryviews
+        :rtype: list
+        """
+        skip = 0 if since is None else self._start(since)
+        count = self.count - skip
+        if count <= 0:
+            return []
+        begin = (self._pos - count) % self.size
+        if self._numpy is not None:
+            times = self.times
+            values = self.values
+        else:
+            times = memoryview(self.times)
+            values = memoryview(self.values)
+        end = begin + count
+        if end <= self.size:
+            return [(times[begin:end], values[begin:end])]
+        end -= self.size
+        return [(times[begin:], values[begin:]),
+                (times[:end], values[:end])]
+
+    def since(self, since=None):
+        """The readings as two sequences, oldest first
+
+        Views into the buffer when the readings are contiguous in it, a
+        copy when they wrap around its end.
+
+        :param since: only readings at or after this time
+        :returns: (times, values)
+        :rtype: tuple
+        """
+        segs = self.segments(since)
+        if len(segs) == 1:
+            return segs[0]
+        if self._numpy is not None:
+            if not segs:
+                return self._numpy.zeros(0), self._numpy.zeros(0)
+            return (self._numpy.concatenate([segs[0][0], segs[1][0]]),
+                    self._numpy.concatenate([segs[0][1], segs[1][1]]))
+        if not segs:
+            return array('d'), array('d')
+        return (array('d', segs[0][0]) + array('d', segs[1][0]),
+                array('d', segs[0][1]) + array('d', segs[1][1]))
+
+    def mean(self, since=None):
+        """Mean of the readings, None if there are none"""
+        total = 0.0
+        count = 0
+        for times, values in self.segments(since):
+            total += float(values.sum()) if self._numpy else sum(values)
+            count += len(values)
+        return total / count if count else None
+
+    def percentile(self, q, since=None):
+        """q-th percentile of the readings, None if there are none
+
+        :param q: percentile, 0 to 100
+        """
+        values = self.since(since)[1]
+        if not len(values):
+            return None
+        if self._numpy is not None:
+            return float(self._numpy.percentile(values, q))
+        return _percentile(values, q)
+
+    def slope(self, since=None):
+        """Least squares trend of the readings, in units per second
+
+        :returns: slope, or None with fewer than two readings or no time
+            spread
+        :rtype: float
+        """
+        segs = self.segments(since)
+        if not segs:
+            return None
+        t0 = segs[0][0][0]
+        n = 0
+        st = sv = stt = stv = 0.0
+        for times, values in segs:
+            n += len(values)
+            if self._numpy is not None:
+                dt = times - t0
+                st += float(dt.sum())
+                sv += float(values.sum())
+                stt += float(dt.dot(dt))
+                stv += float(dt.dot(values))
+            else:
+                for t, v in zip(times, values):
+                    t -= t0
+                    st += t
+                    sv += v
+                    stt += t * t
+                    stv += t * v
+        denom = n * stt - st * st
+        if n < 2 or denom == 0:
+            return None
+        return (n * stv - st * sv) / denom
+
+    def __len__(self):
+        return self.count
+
+
+class HistoryStore:
+    """A History for every device, by uid, all of the same size"""
+
+    def __init__(self, size=1440):
+        self.size = size
+        self._byuid = dict()
+
+    def record(self, uid, value, when):
+        """Add a reading for a device, non numeric values are ignored
+
+        :param uid: device uid
+        :param value: the reading
+        :param when: time of the reading, seconds
+        """
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        hist = self._byuid.get(uid)
+        if hist is None:
+            hist = History(self.size)
+            self._byuid[uid] = hist
+        hist.append(when, value)
+
+    def get(self, uid):
+        """History of a device, or None if nothing was recorded for it"""
+        return self._byuid.get(uid)
+
+    def remove(self, uid):
+        return self._byuid.pop(uid, None)
+
+    def rename(self, olduid, newuid):
+        hist = self._byuid.pop(olduid, None)
+        if hist is not None:
+            self._byuid[newuid] = hist
+
+    def clear(self):
+        self._byuid.clear()
+
+    @property
+    def nbytes(self):
+        """Memory used by the buffers, 16 bytes per sample per device"""
+        return len(self._byuid) * self.size * 16
+
+    def __len__(self):
+        return len(self._byuid)
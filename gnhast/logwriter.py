@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+.. module:: logwriter
+Background log writer for gnhast
+
+The message of a log record is filled in by the caller, so it shows the
+values its arguments had at the time of the call.  Time stamping and
+writing are left to a daemon thread, so a slow log file never holds up
+the event loop.
+"""
+
+import atexit
+from collections import deque
+import sys
+import threading
+import time
+
+
+class LogWriter:
+    """Writes log records on a background thread.
+
+    A record is a stream, a timestamp, a level name and a message.  The
+    message template is filled in with str.format() when the record is
+    queued, and only if there are arguments; the writer thread adds the
+    time stamp and does the I/O.  A record that cannot be written is
+    skipped, the thread keeps going.  The queue holds at most maxsize
+    records; when it is full new records are counted in ``dropped``
+    instead of blocking the caller.  Queueing is a deque append, the
+    writer is only woken when it is idle.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._records = deque()
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stamp = (None, '')
+
+    def timestamp(self, when):
+        """ctime() of a timestamp, cached for the current second"""
+        sec = int(when)
+        cached = self._stamp
+        if cached[0] == sec:
+            return cached[1]
+        stamp = time.ctime(sec)
+        self._stamp = (sec, stamp)
+        return stamp
+
+    @staticmethod
+    def render(msg, args):
+        """Fill in a message template, never raises
+
+        :param msg: message, or str.format() template if there are args
+        :param args: arguments for the template
+        :returns: the message
+        :rtype: str
+        """
+        if not args:
+            return msg
+        try:
+            return msg.format(*args)
+        except Exception:
+            pass
+        parts = []
+        for arg in args:
+            try:
+                parts.append(repr(arg))
+            except Exception:
+                parts.append('<unprintable {0}>'.format(type(arg).__name__))
+        return '{0} ({1})'.format(msg, ', '.join(parts))
+
+    def format(self, when, level, msg, args=()):
+        """Format a record as a log line
+
+        :param when: time.time() of the record
+        :param level: level name, such as 'INFO'
+        :param msg: message, or str.format() template if there are args
+        :param args: arguments for the template
+        :returns: the line, with a newline
+        :rtype: str
+        """
+        return '{0} [{1}]:{2}\n'.format(self.timestamp(when), level,
+                                        self.render(msg, args))
+
+    def write(self, stream, when, level, msg, args=()):
+        """Queue a record, never blocks
+
+        :param stream: file to write the line to
+        :param when: time.time() of the record
+        :param level: level name
+        :param msg: message or template, filled in now
+        :param args: arguments for the template
+        """
+        if self._thread is None:
+            self._start()
+        if len(self._records) >= self.maxsize:
+            self.dropped += 1
+            return
+        self._records.append((stream, when, level, self.render(msg, args)))
+        if not self._wake.is_set():
+            self._wake.set()
+
+    def flush(self):
+        """Wait until every queued record has been written"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._records.append(done)
+        self._wake.set()
+        done.wait()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='gnhast-log', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        reported = 0
+        while True:
+            self._wake.wait()
+            # clear before draining, a record queued after the drain
+            # sets the event again
+            self._wake.clear()
+            records = []
+            while self._records:
+                records.append(self._records.popleft())
+            try:
+                reported = self._write_records(records, reported)
+            except Exception:
+                # never let the thread die, nothing would restart it
+                pass
+            finally:
+                for rec in records:
+                    if isinstance(rec, threading.Event):
+                        rec.set()
+
+    def _write_records(self, records, reported):
+        stream = None
+        lines = []
+        if self.dropped != reported:
+            lines.append(self.format(
+                time.time(), 'WARNING',
+                '{0} log records dropped, log queue full',
+                (self.dropped - reported,)))
+            reported = self.dropped
+            stream = sys.stderr
+            for rec in records:
+                if not isinstance(rec, threading.Event):
+                    stream = rec[0]
+                    break
+        # group consecutive lines for the same stream into one write
+        for rec in records:
+            if isinstance(rec, threading.Event):
+                self._emit(stream, lines)
+                lines = []
+                rec.set()
+                continue
+            if rec[0] is not stream and lines:
+                self._emit(stream, lines)
+                lines = []
+            stream = rec[0]
+            lines.append('{0} [{1}]:{2}\n'.format(
+                self.timestamp(rec[1]), rec[2], rec[3]))
+        self._emit(stream, lines)
+        return reported
+
+    def _emit(self, stream, lines):
+        if not lines:
+            return
+        try:
+            stream.write(''.join(lines))
+            stream.flush()
+        except Exception:
+            # the stream may have been closed under us by log_open()
+            pass
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+.. module:: outqueue
+Outbound line queue that coalesces device updates
+"""
+
+from collections import OrderedDict
+import itertools
+
+
+class CoalescingQueue:
+    """FIFO of outbound protocol lines where updates are latest-value-wins.
+
+    Lines put with a uid are device updates: a newer update for a uid that
+    is still queued replaces the queued one in place, so only the newest
+    value goes out.  Lines put without a uid (reg, setalarm, imalive,
+    disconnect, ...) are never coalesced and never dropped.  Once the
+    queue holds maxdepth lines, the oldest queued update is dropped to
+    make room.
+    """
+
+    def __init__(self, maxdepth=1000):
+        self.maxdepth = maxdepth
+        self.coalesced = 0
+        self.dropped = 0
+        self._lines = OrderedDict()
+        self._seq = itertools.count()
+
+    def put(self, line, uid=None):
+        """Queue a line
+
+        :param line: encoded protocol line
+        :param uid: uid of the device, for updates that may be coalesced
+        """
+        if uid is not None:
+            key = ('upd', uid)
+            if key in self._lines:
+                self._lines[key] = line
+                self.coalesced += 1
+                return
+        else:
+            key = next(self._seq)
+        if len(self._lines) >= self.maxdepth:
+            for old in self._lines:
+                if isinstance(old, tuple):
+                    del self._lines[old]
+                    self.dropped += 1
+                    break
+        self._lines[key] = line
+
+    def take(self):
+        """Remove and return everything queued, oldest first
+
+        :returns: list of encoded lines
+        :rtype: list
+        """
+        lines = list(self._lines.values())
+        self._lines.clear()
+        return lines
+
+    def __len__(self):
+        return len(self._lines)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+.. module:: protocol
+Tokenizer and word tables for the gnhast wire protocol
+
+A gnhast line looks like ``cmd key:value key:"quoted value"``.  This
+splits it into the command verb and a list of (key, value) pairs, with
+the same quoting rules shlex.split() applies in POSIX mode, but without
+running shlex's character-at-a-time lexer on every line.
+"""
+
+import re
+
+# Data word for each device subtype, indexed by subtype number.  Used to
+# decode incoming data words and to encode outgoing updates.
+DATA_WORDS = ("none", "switch", "switch", "temp", "humid",
+              "count", "pres", "speed", "dir", "ph", "wet",
+              "hub", "lux", "volts", "wsec", "watt", "amps",
+              "rain", "weather", "alarm", "number", "pct",
+              "flow", "distance", "volume", "timer",
+              "thmode", "thstate", "smnum", "blind",
+              "collector", "trigger", "orp", "salinity",
+              "daylight", "moonph", "tristate")
+
+
+def typeofvalue(text):
+    """Convert a protocol value to int, float or str, whichever fits first"""
+    try:
+        return int(text)
+    except ValueError:
+        pass
+
+    try:
+        return float(text)
+    except ValueError:
+        pass
+
+    return str(text)
+
+
+# Non-data words: wire key, device/alarm field, converter
+FIELD_WORDS = (
+    ('uid', 'uid', str),
+    ('name', 'name', str),
+    ('rate', 'rate', typeofvalue),
+    ('rrdname', 'rrdname', str),
+    ('devt', 'type', typeofvalue),
+    ('proto', 'proto', typeofvalue),
+    ('subt', 'subtype', typeofvalue),
+    ('client', 'client', str),
+    ('scale', 'scale', typeofvalue),
+    ('handler', 'handler', typeofvalue),
+    ('hargs', 'hargs', str),
+    ('tags', 'tags', str),
+    ('glist', 'glist', str),
+    ('dlist', 'dlist', str),
+    ('collector', 'collector', str),
+    ('alsev', 'alsev', typeofvalue),
+    ('altext', 'altext', str),
+    ('aluid', 'aluid', str),
+    ('alchan', 'alchan', typeofvalue),
+    ('spamhandler', 'spamhandler', typeofvalue),
+    ('data', 'data', typeofvalue),
+    ('hiwat', 'hiwat', typeofvalue),
+    ('lowat', 'lowat', typeofvalue),
+)
+
+
+def build_word_map():
+    """Build the wire key -> (field, converter) decode table
+
+    Every subtype data word, plus ``dimmer``, decodes into ``data``.  Data
+    words win over field words of the same name (``collector``).
+
+    :returns: decode table
+    :rtype: dict
+    """
+    word_map = dict()
+    for word, field, conv in FIELD_WORDS:
+        word_map[word] = (field, conv)
+    for word in DATA_WORDS:
+        word_map[word] = ('data', typeofvalue)
+    word_map['dimmer'] = ('data', typeofvalue)
+    return word_map
+
+
+# One shell-style word: runs of plain characters, quoted strings and
+# backslash escapes, glued together.
+_WORD = re.compile(r'''\s*((?:[^\s"'\\]+|"(?:[^"\\]|\\.)*"|'[^']*'|\\.)+)''',
+                   re.DOTALL)
+# The pieces of a word that need unquoting
+_PIECE = re.compile(r'''"((?:[^"\\]|\\.)*)"|'([^']*)'|\\(.)|([^"'\\]+)''',
+                    re.DOTALL)
+# Inside double quotes, POSIX shlex only lets \ escape " and \
+_DQ_ESCAPE = re.compile(r'\\([\\"])')
+
+
+def _unquote(word):
+    out = []
+    for m in _PIECE.finditer(word):
+        dq, sq, esc, plain = m.groups()
+        if plain is not None:
+            out.append(plain)
+        elif dq is not None:
+            out.append(_DQ_ESCAPE.sub(r'\1', dq))
+        elif sq is not None:
+            out.append(sq)
+        else:
+            out.append(esc)
+    return ''.join(out)
+
+
+def split_words(line):
+    """Split a line into words, honouring shell-style quoting
+
+    :param line: the line, as str
+    :returns: list of words with quotes removed
+    :rtype: list
+    :raises ValueError: on an unterminated quote or trailing backslash
+    """
+    if '"' not in line and "'" not in line and '\\' not in line:
+        return line.split()
+
+    words = []
+    pos = 0
+    end = len(line.rstrip())
+    while pos < end:
+        m = _WORD.match(line, pos)
+        if m is None:
+            raise ValueError('No closing quotation')
+        word = m.group(1)
+        if '"' in word or "'" in word or '\\' in word:
+            word = _unquote(word)
+        words.append(word)
+        pos = m.end()
+    return words
+
+
+def tokenize(line):
+    """Tokenize one gnhast protocol line
+
+    :param line: the raw line, bytes or str
+    :returns: list of the command verb followed by (key, value) tuples.
+        A word without a ``:`` gives a pair with an empty value.
+    :rtype: list
+    :raises ValueError: on an unterminated quote
+    """
+    if isinstance(line, bytes):
+        line = line.decode()
+    words = split_words(line)
+    if not words:
+        return words
+    cmd = [words[0]]
+    for word in words[1:]:
+        key, sep, value = word.partition(':')
+        cmd.append((key, value))
+    return cmd
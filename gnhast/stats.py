@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+.. module:: stats
+Incremental per device statistics
+
+Every numeric data value a device takes is folded into a few running
+numbers, in O(1) time and without keeping the history around: min, max,
+an exponentially weighted mean, optionally the mean over a sliding time
+window, and the rate of change per second.
+"""
+
+from collections import deque
+import math
+
+
+class RunningStats:
+    """Running statistics of one device"""
+
+    __slots__ = ('count', 'min', 'max', 'ewma', 'last', 'last_time',
+                 'rate', '_window', '_wsum')
+
+    def __init__(self, windowed=False):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.ewma = None
+        self.last = None
+        self.last_time = None
+        self.rate = 0.0
+        self._window = deque() if windowed else None
+        self._wsum = 0.0
+
+    @property
+    def window_mean(self):
+        """Mean over the time window, None without a window or data"""
+        if not self._window:
+            return None
+        return self._wsum / len(self._window)
+
+    @property
+    def mean(self):
+        """The window mean if there is a window, else the EWMA"""
+        if self._window is not None:
+            return self.window_mean
+        return self.ewma
+
+    def as_dict(self):
+        return {
+            'count': self.count, 'min': self.min, 'max': self.max,
+            'ewma': self.ewma, 'window_mean': self.window_mean,
+            'mean': self.mean, 'rate': self.rate, 'last': self.last,
+            'last_time': self.last_time,
+        }
+
+
+class StatsTable:
+    """RunningStats for every device, by uid.
+
+    :param window: length of the sliding window in seconds for the
+        windowed mean, None for no window
+    :param tau: time constant of the EWMA in seconds.  A sample dt
+        seconds after the previous one gets weight 1 - exp(-dt / tau), so
+        irregular update intervals are weighted fairly.
+    """
+
+    def __init__(self, window=None, tau=60.0):
+        self.window = window
+        self.tau = tau
+        self._byuid = dict()
+
+    def update(self, uid, value, when):
+        """Fold a new value into the statistics of a device
+
+        :param uid: device uid
+        :param value: the new data value, int or float
+        :param when: time of the value, in seconds
+        :returns: the device's statistics
+        :rtype: RunningStats
+        """
+        st = self._byuid.get(uid)
+        if st is None:
+            st = RunningStats(self.window is not None)
+            self._byuid[uid] = st
+
+        if st.count == 0:
+            st.min = st.max = st.ewma = value
+        else:
+            if value < st.min:
+                st.min = value
+            elif value > st.max:
+                st.max = value
+            dt = when - st.last_time
+            if dt > 0:
+                st.rate = (value - st.last) / dt
+                weight = 1.0 - math.exp(-dt / self.tau)
+                st.ewma += (value - st.ewma) * weight
+        st.count += 1
+        st.last = value
+        st.last_time = when
+
+        window = st._window
+        if window is not None:
+            window.append((when, value))
+            st._wsum += value
+            start = when - self.window
+            while window[0][0] < start:
+                st._wsum -= window.popleft()[1]
+        return st
+
+    def get(self, uid):
+        """Statistics of a device, or None if it has none yet"""
+        return self._byuid.get(uid)
+
+    def remove(self, uid):
+        """Forget the statistics of a device"""
+        return self._byuid.pop(uid, None)
+
+    def clear(self):
+        self._byuid.clear()
+
+    def __len__(self):
+        return len(self._byuid)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+.. module:: subscriptions
+Device callback subscriptions for gnhast
+"""
+
+import itertools
+
+EVENTS = ('reg', 'upd', 'chg')
+
+
+def dev_tags(dev):
+    """The tags of a device, as a collection of tag names
+
+    Tags come from gnhastd as a comma separated string, or are set up as
+    a dict by collectors.
+    """
+    tags = dev['tags']
+    if isinstance(tags, str):
+        return tags.split(',') if tags else ()
+    return tags
+
+
+class Subscription:
+    """One registered callback and the devices it is interested in.
+
+    A filter left at None matches every device.
+    """
+
+    __slots__ = ('event', 'callback', 'uid', 'subtype', 'type', 'tag',
+                 'seq')
+
+    def __init__(self, event, callback, uid=None, subtype=None, type=None,
+                 tag=None, seq=0):
+        self.event = event
+        self.callback = callback
+        self.uid = uid
+        self.subtype = subtype
+        self.type = type
+        self.tag = tag
+        self.seq = seq
+
+    def matches(self, dev):
+        """Check a device against every filter of the subscription"""
+        if self.uid is not None and dev['uid'] != self.uid:
+            return False
+        if self.subtype is not None and dev['subtype'] != self.subtype:
+            return False
+        if self.type is not None and dev['type'] != self.type:
+            return False
+        if self.tag is not None and self.tag not in dev_tags(dev):
+            return False
+        return True
+
+    def __repr__(self):
+        return 'Subscription({0!r}, {1!r}, uid={2!r}, subtype={3!r}, ' \
+            'type={4!r}, tag={5!r})'.format(self.event, self.callback,
+                                            self.uid, self.subtype,
+                                            self.type, self.tag)
+
+
+class SubscriptionRegistry:
+    """Subscriptions indexed by event and by their most selective filter.
+
+    Each subscription is filed under exactly one index: its uid if it has
+    one, else its subtype, else its type, else its tag, else the list of
+    subscriptions that want every device.  Finding the callbacks for a
+    device only looks at the buckets for that device's uid, subtype and
+    type, the tag buckets and the catch-all list, so the cost grows with
+    the number of matching subscriptions rather than with all of them.
+    """
+
+    def __init__(self):
+        self._seq = itertools.count()
+        self._index = dict()
+        for event in EVENTS:
+            self._index[event] = {
+                'uid': dict(), 'subtype': dict(), 'type': dict(),
+                'tag': dict(), 'all': [],
+            }
+
+    def _bucket(self, sub, create):
+        index = self._index[sub.event]
+        for field in ('uid', 'subtype', 'type', 'tag'):
+            key = getattr(sub, field)
+            if key is not None:
+                if create:
+                    return index[field].setdefault(key, [])
+                return index[field].get(key)
+        return index['all']
+
+    def add(self, event, callback, uid=None, subtype=None, type=None,
+            tag=None):
+        """Register a callback
+
+        :param event: 'reg', 'upd' or 'chg'
+        :param callback: called with the device
+        :param uid: only devices with this uid
+        :param subtype: only devices of this subtype (int)
+        :param type: only devices of this type (int)
+        :param tag: only devices carrying this tag
+        :returns: the subscription, pass it to remove() to unsubscribe
+        :rtype: Subscription
+        :raises ValueError: for an unknown event
+        """
+        if event not in self._index:
+            raise ValueError('unknown event {0!r}'.format(event))
+        sub = Subscription(event, callback, uid, subtype, type, tag,
+                           next(self._seq))
+        self._bucket(sub, True).append(sub)
+        return sub
+
+    def remove(self, sub):
+        """Remove a subscription
+
+        :param sub: subscription returned by add()
+        :returns: True if it was registered
+        :rtype: bool
+        """
+        bucket = self._bucket(sub, False)
+        if bucket is None or sub not in bucket:
+            return False
+        bucket.remove(sub)
+        if not bucket:
+            index = self._index[sub.event]
+            for field in ('uid', 'subtype', 'type', 'tag'):
+                key = getattr(sub, field)
+                if key is not None:
+                    del index[field][key]
+                    break
+        return True
+
+    def match(self, event, dev):
+        """Find the subscriptions a device event should be delivered to
+
+        :param event: 'reg', 'upd' or 'chg'
+        :param dev: the device
+        :returns: matching subscriptions, in the order they were added
+        :rtype: list
+        """
+        index = self._index[event]
+        found = []
+        bucket = index['uid'].get(dev['uid'])
+        if bucket:
+            found.extend(bucket)
+        if index['subtype']:
+            bucket = index['subtype'].get(dev['subtype'])
+            if bucket:
+                found.extend(bucket)
+        if index['type']:
+            bucket = index['type'].get(dev['type'])
+            if bucket:
+                found.extend(bucket)
+        if index['tag']:
+            for tag in set(dev_tags(dev)):
+                bucket = index['tag'].get(tag)
+                if bucket:
+                    found.extend(bucket)
+        found.extend(index['all'])
+        if not found:
+            return found
+        found = [sub for sub in found if sub.matches(dev)]
+        if len(found) > 1:
+            found.sort(key=lambda sub: sub.seq)
+        return found
+
+    def __len__(self):
+        count = 0
+        for index in self._index.values():
+            for field in ('uid', 'subtype', 'type', 'tag'):
+                for bucket in index[field].values():
+                    count += len(bucket)
+            count += len(index['all'])
+        return count
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+.. module:: units
+Unit conversion for gnhast scales
+
+Every gnhast scale family (temperature, speed, length, barometric
+pressure, light and salinity) converts linearly or affinely between its
+scales, so conversions are done with precomputed coefficient tables
+instead of building pint quantities; tests/test_units.py checks the
+tables against pint.  numpy is only loaded on the first batch
+conversion.
+"""
+
+# Scale names, in the order gnhast numbers them (the cf_*scale lists)
+TSCALE = ['f', 'c', 'k', 'r']
+SPEEDSCALE = ['mph', 'ms', 'kph', 'knots']
+LENGTHSCALE = ['in', 'mm']
+BAROSCALE = ['in', 'mm', 'mb', 'cb']
+LIGHTSCALE = ['wm2', 'lux']
+SALINESCALE = ['ppt', 'sg', 'ms']
+
+# For each family, how to get to a base unit: base = value * mul + add
+# kelvin
+TEMP_TO_K = [
+    (5.0 / 9.0, 459.67 * 5.0 / 9.0),
+    (1.0, 273.15),
+    (1.0, 0.0),
+    (5.0 / 9.0, 0.0),
+]
+# meters per second
+SPEED_TO_MS = [
+    (0.44704, 0.0),
+    (1.0, 0.0),
+    (1.0 / 3.6, 0.0),
+    (1852.0 / 3600.0, 0.0),
+]
+# millimeters
+LENGTH_TO_MM = [
+    (25.4, 0.0),
+    (1.0, 0.0),
+]
+# millibars; inches and mm of mercury at 0C
+BARO_TO_MB = [
+    (33.8638866667, 0.0),
+    (1.33322387415, 0.0),
+    (1.0, 0.0),
+    (10.0, 0.0),
+]
+# W/m2; 126.7 lux per W/m2 is the usual figure for sunlight
+LIGHT_TO_WM2 = [
+    (1.0, 0.0),
+    (1.0 / 126.7, 0.0),
+]
+# ppt; seawater at 25C: 35 ppt = 1.0264 sg = 53 mS/cm
+SALINE_TO_PPT = [
+    (1.0, 0.0),
+    (35.0 / 0.0264, -35.0 / 0.0264),
+    (35.0 / 53.0, 0.0),
+]
+
+
+def _affine_table(to_base):
+    """Precompute y = x * mul + add for every (from, to) pair"""
+    table = []
+    for m1, a1 in to_base:
+        row = []
+        for m2, a2 in to_base:
+            row.append((m1 / m2, (a1 - a2) / m2))
+        table.append(row)
+    return table
+
+
+TEMP_TABLE = _affine_table(TEMP_TO_K)
+
+# family (the device/config key) -> (scale names, conversion table)
+FAMILIES = {
+    'tscale': (TSCALE, TEMP_TABLE),
+    'speedscale': (SPEEDSCALE, _affine_table(SPEED_TO_MS)),
+    'lengthscale': (LENGTHSCALE, _affine_table(LENGTH_TO_MM)),
+    'baroscale': (BAROSCALE, _affine_table(BARO_TO_MB)),
+    'lightscale': (LIGHTSCALE, _affine_table(LIGHT_TO_WM2)),
+    'salinescale': (SALINESCALE, _affine_table(SALINE_TO_PPT)),
+}
+
+# device subtype -> scale family its data is measured in
+SUBTYPE_FAMILY = {
+    3: 'tscale',        # temp
+    6: 'baroscale',     # pressure
+    7: 'speedscale',    # windspeed
+    12: 'lightscale',   # lux
+    17: 'lengthscale',  # rainrate
+    23: 'lengthscale',  # distance
+    33: 'salinescale',  # salinity
+}
+
+_numpy = False
+
+
+def get_numpy():
+    """numpy, imported on first use
+
+    :returns: the numpy module, or None if it is not installed
+    """
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = None
+    return _numpy
+
+
+def _apply(values, mul, add):
+    if isinstance(values, (int, float)):
+        return values * mul + add
+    numpy = get_numpy()
+    if numpy is not None:
+        return numpy.asarray(values, dtype=float) * mul + add
+    return [v * mul + add for v in values]
+
+
+def _scale_index(names, scale):
+    if isinstance(scale, str):
+        if scale.lower() in names:
+            return names.index(scale.lower())
+    elif 0 <= int(scale) < len(names):
+        return int(scale)
+    raise ValueError('unknown scale {0!r}'.format(scale))
+
+
+def convert_scale(values, family, cur, new):
+    """Convert values between two scales of a family
+
+    :param values: a number, or a sequence or numpy array of numbers
+    :param family: scale family, a key of FAMILIES such as 'baroscale'
+    :param cur: current scale, name or index
+    :param new: new scale, name or index
+    :returns: a number for a number, otherwise a numpy array if numpy is
+        installed, else a list
+    :raises ValueError: for an unknown family or scale
+    """
+    if family not in FAMILIES:
+        raise ValueError('unknown scale family {0!r}'.format(family))
+    names, table = FAMILIES[family]
+    mul, add = table[_scale_index(names, cur)][_scale_index(names, new)]
+    return _apply(values, mul, add)
+
+
+def convert(values, subtype, cur, new):
+    """Convert device data between two scales
+
+    :param values: a number, or a sequence or numpy array of numbers
+    :param subtype: device subtype (int), picks the scale family
+    :param cur: current scale, name or index
+    :param new: new scale, name or index
+    :returns: converted values, see convert_scale()
+    :raises ValueError: if the subtype has no scales, or a scale is unknown
+    """
+    if subtype not in SUBTYPE_FAMILY:
+        raise ValueError('subtype {0} has no scales'.format(subtype))
+    return convert_scale(values, SUBTYPE_FAMILY[subtype], cur, new)
+
+
+def scale_temp(temp, cur, new):
+    """Rescale a temperature
+
+    :param temp: temperature
+    :param cur: current scale, index into TSCALE
+    :param new: new scale, index into TSCALE
+    :returns: temperature in the new scale
+    :rtype: float
+    """
+    mul, add = TEMP_TABLE[cur][new]
+    return temp * mul + add
+
+
+def scale_temps(temps, cur, new):
+    """Rescale a sequence of temperatures in one go
+
+    :param temps: sequence or numpy array of temperatures
+    :param cur: current scale, index into TSCALE
+    :param new: new scale, index into TSCALE
+    :returns: numpy array if numpy is available, else a list
+    """
+    mul, add = TEMP_TABLE[cur][new]
+    numpy = get_numpy()
+    if numpy is not None:
+        return numpy.asarray(temps, dtype=float) * mul + add
+    return [t * mul + add for t in temps]
@@ -24,10 +24,12 @@ setup(
         'Gnhast Python Collectors': 'https://github.com/garbled1/gnhast-python-collectors',
     },
     install_requires=[
-        'pint',
-        'ply',
         'py-flags'
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'pint': ['pint']
+    },
     python_requires='>=3.5',
     long_description=long_description,
     long_description_content_type='text/markdown'
@@ -11,9 +11,8 @@ x.loop.run_until_complete(x.gn_build_client('foo'))
 x.write_conf_file("foo")
 
 async def fiddle():
-    msg = 'ldevs\n'
-    x.writer.write(msg.encode())
-    await asyncio.sleep(5)
+    async for dev in x.gn_list_devices(timeout=5):
+        pprint(dev)
     await x.gn_disconnect()
 
 x.loop.create_task(x.gnhastd_listener())
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""
+Tests for the columnar device table
+"""
+
+import unittest
+
+from gnhast import units
+from gnhast.columnar import ColumnarRegistry
+from gnhast.devices import Device
+
+
+class TestGrow(unittest.TestCase):
+
+    def grow_with_view(self):
+        reg = ColumnarRegistry(capacity=16)
+        for i in range(10):
+            reg.add(Device('u{0}'.format(i), 'Dev', 3, 3, data=float(i)))
+        view = reg.column('data')
+        for i in range(10, 100):
+            reg.add(Device('u{0}'.format(i), 'Dev', 3, 3, data=float(i)))
+        self.assertEqual(len(view), 10)
+        self.assertEqual(view[5], 5.0)
+        self.assertEqual(len(reg.column('data')), 100)
+        self.assertEqual(reg.find('u77')['data'], 77.0)
+        self.assertEqual(len(reg.select(above=50)), 49)
+
+    def test_grow_with_view(self):
+        self.grow_with_view()
+
+    def test_grow_with_view_without_numpy(self):
+        saved = units._numpy
+        units._numpy = None
+        try:
+            self.grow_with_view()
+        finally:
+            units._numpy = saved
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Tests for writing config files
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from gnhast.gnhast import _write_if_changed
+
+
+class TestWriteIfChanged(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.conf')
+        with open(self.path, 'w') as f:
+            f.write('old\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_unchanged(self):
+        self.assertFalse(_write_if_changed(self.path, b'old\n'))
+        self.assertTrue(_write_if_changed(self.path, b'new\n'))
+        self.assertEqual(self.read(), b'new\n')
+        self.assertEqual(os.listdir(self.tmpdir), ['test.conf'])
+
+    def test_keeps_mode(self):
+        os.chmod(self.path, 0o640)
+        _write_if_changed(self.path, b'new\n')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), 'no symlinks')
+    def test_follows_symlink(self):
+        link = os.path.join(self.tmpdir, 'link.conf')
+        os.symlink(self.path, link)
+        _write_if_changed(link, b'new\n')
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(self.read(), b'new\n')
+
+    @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0,
+                         'only root can give files away')
+    def test_keeps_owner(self):
+        os.chown(self.path, 1000, 1000)
+        _write_if_changed(self.path, b'new\n')
+        st = os.stat(self.path)
+        self.assertEqual((st.st_uid, st.st_gid), (1000, 1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
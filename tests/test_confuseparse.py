@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Parity tests for the config parser
+
+Every configs/NAME.conf is parsed and compared with configs/NAME.json,
+the result the old ply based parser gave for the same file (after
+parse_cfg had added its semicolons).
+"""
+
+import glob
+import json
+import os
+import unittest
+
+from gnhast import confuseparse
+
+CONFIGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configs')
+
+
+def samples():
+    for conf in sorted(glob.glob(os.path.join(CONFIGS, '*.conf'))):
+        name = os.path.splitext(os.path.basename(conf))[0]
+        with open(os.path.join(CONFIGS, name + '.json')) as f:
+            yield name, conf, json.load(f)
+
+
+class TestParity(unittest.TestCase):
+
+    def test_parse_lines(self):
+        for name, conf, expected in samples():
+            with self.subTest(config=name):
+                with open(conf) as f:
+                    self.assertEqual(confuseparse.parse_lines(f), expected)
+
+    def test_parse(self):
+        for name, conf, expected in samples():
+            with self.subTest(config=name):
+                with open(conf) as f:
+                    self.assertEqual(confuseparse.parse(f.read()), expected)
+
+    def test_devices(self):
+        for name, conf, expected in samples():
+            with self.subTest(config=name):
+                with open(conf) as f:
+                    config = confuseparse.parse_lines(f, devices=True)
+                devs = dict()
+                for key in list(expected):
+                    if key.startswith('device-'):
+                        dev = expected.pop(key)
+                        dev['uid'] = key[7:]
+                        devs[key[7:]] = dev
+                expected['devices'] = devs
+                self.assertTrue(devs)
+                self.assertEqual(config, expected)
+
+    def test_types(self):
+        with open(os.path.join(CONFIGS, 'network.conf')) as f:
+            config = confuseparse.parse_lines(f)
+        wifi = config['wifi']
+        self.assertIsInstance(wifi['scan'], float)
+        self.assertIsInstance(wifi['nested']['level'], int)
+        self.assertEqual(wifi['ports'], [22, 80, 443])
+        self.assertEqual(wifi['router'], '00:1a:2b:3c:4d:5e')
+
+
+class TestChanges(unittest.TestCase):
+    """Input the ply lexer rejected"""
+
+    def test_escapes(self):
+        config = confuseparse.parse('a {\n x = "say \\"hi\\" \\\\ ok"\n}\n')
+        self.assertEqual(config, {'a': {'x': 'say "hi" \\ ok'}})
+
+    def test_floats(self):
+        config = confuseparse.parse('a {\n x = 12.5\n y = -0.5\n}\n')
+        self.assertEqual(config, {'a': {'x': 12.5, 'y': -0.5}})
+
+    def test_trailing_comment(self):
+        config = confuseparse.parse('a {\n x = 1  # one\n y = 2\n}\n')
+        self.assertEqual(config, {'a': {'x': 1, 'y': 2}})
+
+    def test_multiline_string(self):
+        with self.assertRaises(confuseparse.Error):
+            confuseparse.parse('a {\n x = "one\ntwo"\n}\n')
+
+    def test_errors(self):
+        with self.assertRaises(confuseparse.SyntaxError):
+            confuseparse.parse('a {\n x = 1\n')
+        with self.assertRaises(confuseparse.SyntaxError):
+            confuseparse.parse('a {\n x = 1,\n}\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""
+Guards against slow imports
+
+import gnhast.gnhast must not load the heavy optional modules; they are
+only imported when something needs them.  Each check runs in a fresh
+interpreter, so modules loaded by other tests do not count.
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ['pint', 'numpy', 'ply', 'gnhast.confuseparse']
+
+CHECK = '''
+import sys
+import gnhast.gnhast
+print(' '.join(sorted(set(sys.argv[1:]) & set(sys.modules))))
+'''
+
+
+class TestImport(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        out = subprocess.run([sys.executable, '-c', CHECK] + HEAVY,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             universal_newlines=True, cwd=ROOT)
+        self.assertEqual(out.returncode, 0, out.stderr)
+        loaded = out.stdout.split()
+        self.assertEqual(loaded, [],
+                         'imported eagerly: {0}'.format(', '.join(loaded)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Tests for the background log writer
+"""
+
+import io
+import time
+import unittest
+
+from gnhast.logwriter import LogWriter
+
+
+class Unprintable:
+
+    def __str__(self):
+        raise RuntimeError('str')
+
+    def __repr__(self):
+        raise RuntimeError('repr')
+
+    def __format__(self, spec):
+        raise RuntimeError('format')
+
+
+class TestLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.out = io.StringIO()
+        self.writer = LogWriter()
+
+    def lines(self):
+        self.writer.flush()
+        return [line.partition(']:')[2]
+                for line in self.out.getvalue().splitlines()]
+
+    def test_bad_argument(self):
+        self.writer.write(self.out, time.time(), 'INFO', 'bad {0}',
+                          (Unprintable(),))
+        self.writer.write(self.out, time.time(), 'INFO', 'still {0}', (1,))
+        self.assertEqual(self.lines(),
+                         ['bad {0} (<unprintable Unprintable>)', 'still 1'])
+        self.assertTrue(self.writer._thread.is_alive())
+
+    def test_values_at_call_time(self):
+        dev = {'data': 1}
+        self.writer.write(self.out, time.time(), 'INFO', 'dev {0}', (dev,))
+        dev['data'] = 2
+        self.assertEqual(self.lines(), ["dev {'data': 1}"])
+
+    def test_broken_stream(self):
+        class Broken:
+            def write(self, data):
+                raise OSError('closed')
+        self.writer.write(Broken(), time.time(), 'INFO', 'lost')
+        self.writer.write(self.out, time.time(), 'INFO', 'kept')
+        self.assertEqual(self.lines(), ['kept'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Checks the unit conversion tables against pint
+"""
+
+import unittest
+
+from gnhast import units
+
+try:
+    import pint
+except ImportError:
+    pint = None
+
+# pint names for the scales of each family, in gnhast order
+PINT_UNITS = {
+    'tscale': ['degF', 'degC', 'kelvin', 'degR'],
+    'speedscale': ['mph', 'm/s', 'km/h', 'knot'],
+    'lengthscale': ['inch', 'mm'],
+    'baroscale': ['inHg', 'mmHg', 'mbar', 'cbar'],
+}
+VALUES = [-40.0, 0.0, 21.5, 100.0, 1013.25]
+
+
+@unittest.skipIf(pint is None, 'pint is not installed')
+class TestPintParity(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.ureg = pint.UnitRegistry()
+
+    def check_family(self, family):
+        names = units.FAMILIES[family][0]
+        pint_units = PINT_UNITS[family]
+        self.assertEqual(len(names), len(pint_units))
+        for cur, cur_unit in enumerate(pint_units):
+            for new, new_unit in enumerate(pint_units):
+                for value in VALUES:
+                    with self.subTest(family=family, cur=names[cur],
+                                      new=names[new], value=value):
+                        expected = self.ureg.Quantity(value, cur_unit) \
+                            .to(new_unit).magnitude
+                        got = units.convert_scale(value, family, cur, new)
+                        self.assertAlmostEqual(
+                            got, expected,
+                            delta=1e-7 * max(1.0, abs(expected)))
+
+    def test_tscale(self):
+        self.check_family('tscale')
+
+    def test_speedscale(self):
+        self.check_family('speedscale')
+
+    def test_lengthscale(self):
+        self.check_family('lengthscale')
+
+    def test_baroscale(self):
+        self.check_family('baroscale')
+
+
+class TestTables(unittest.TestCase):
+    """Checks that do not need pint.  Light and salinity scales cannot be
+    converted by pint, so they are checked on known values."""
+
+    def test_tscale_pairs(self):
+        # scale_temp and the batch path use the same table, all 16 pairs
+        n = len(units.TSCALE)
+        for cur in range(n):
+            for new in range(n):
+                with self.subTest(cur=cur, new=new):
+                    one = [units.scale_temp(t, cur, new) for t in VALUES]
+                    many = list(units.scale_temps(VALUES, cur, new))
+                    for a, b in zip(one, many):
+                        self.assertAlmostEqual(a, b)
+                    self.assertEqual(
+                        one, [units.convert_scale(t, 'tscale', cur, new)
+                              for t in VALUES])
+
+    def test_lightscale(self):
+        self.assertAlmostEqual(
+            units.convert_scale(1.0, 'lightscale', 'wm2', 'lux'), 126.7)
+        self.assertAlmostEqual(
+            units.convert_scale(126.7, 'lightscale', 'lux', 'wm2'), 1.0)
+
+    def test_salinescale(self):
+        # seawater at 25C: 35 ppt = 1.0264 sg = 53 mS/cm
+        for cur, value in (('ppt', 35.0), ('sg', 1.0264), ('ms', 53.0)):
+            for new, expected in (('ppt', 35.0), ('sg', 1.0264),
+                                  ('ms', 53.0)):
+                with self.subTest(cur=cur, new=new):
+                    self.assertAlmostEqual(
+                        units.convert_scale(value, 'salinescale', cur, new),
+                        expected)
+
+    def test_round_trip(self):
+        for family, (names, table) in units.FAMILIES.items():
+            for cur in range(len(names)):
+                for new in range(len(names)):
+                    with self.subTest(family=family, cur=cur, new=new):
+                        there = units.convert_scale(42.0, family, cur, new)
+                        back = units.convert_scale(there, family, new, cur)
+                        self.assertAlmostEqual(back, 42.0)
+
+    def test_unknown_scale(self):
+        with self.assertRaises(ValueError):
+            units.convert_scale(1.0, 'tscale', 'kelvin', 'c')
+        with self.assertRaises(ValueError):
+            units.convert_scale(1.0, 'tscale', 4, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
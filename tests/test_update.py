@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Tests for sending device updates
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from gnhast import gnhast
+
+CONFIG = '''device "28.0a0b0c000000" {
+  name = "Outside temperature"
+  proto = sensor-owfs
+  type = sensor
+  subtype = temp
+}
+'''
+
+
+class FakeWriter:
+
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    async def drain(self):
+        pass
+
+
+class TestConfigDevices(unittest.TestCase):
+    """Devices loaded by parse_cfg only carry the keys set in the file"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cfg = os.path.join(self.tmpdir, 'test.conf')
+        with open(self.cfg, 'w') as f:
+            f.write(CONFIG)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def send(self, coro_func, full):
+        loop = asyncio.new_event_loop()
+        try:
+            gn = gnhast.gnhast(loop, self.cfg)
+            gn.parse_cfg()
+            dev = gn.devices.find('28.0a0b0c000000')
+            self.assertNotIn('scale', dev)
+            dev['data'] = 21.5
+            gn.writer = FakeWriter()
+            gn.connected = True
+            loop.run_until_complete(coro_func(gn, dev, full))
+            return gn.writer.data
+        finally:
+            loop.close()
+
+    def test_update_devices(self):
+        for full in (False, True):
+            with self.subTest(full=full):
+                one = self.send(
+                    lambda gn, dev, full: gn.gn_update_device(dev, full),
+                    full)
+                many = self.send(
+                    lambda gn, dev, full: gn.gn_update_devices([dev], full),
+                    full)
+                self.assertTrue(one.startswith(b'upd uid:28.0a0b0c000000 '))
+                self.assertTrue(one.endswith(b':21.5\n'))
+                self.assertEqual(many, one)
+
+
+if __name__ == '__main__':
+    unittest.main()